@@ -9,8 +9,15 @@ https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
 
 import os
 
+from django.conf import settings
+from django.contrib.staticfiles.handlers import ASGIStaticFilesHandler
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'BroadcastBot.settings')
 
 application = get_asgi_application()
+
+# The live progress stream needs an ASGI server, so run.sh serves the app with uvicorn
+# instead of runserver; serve static files the way runserver does while developing
+if settings.DEBUG:
+    application = ASGIStaticFilesHandler(application)
@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
+import os
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -77,12 +79,43 @@ WSGI_APPLICATION = 'BroadcastBot.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# DB_ENGINE selects the backend: "sqlite3" (default) or "postgresql", which needs psycopg installed
+DB_ENGINE = os.environ.get("DB_ENGINE", "sqlite3")
+
+if DB_ENGINE == "sqlite3":
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.environ.get("DB_NAME", BASE_DIR / 'db.sqlite3'),
+            'OPTIONS': {
+                # WAL lets API reads and worker writes run at the same time; NORMAL sync is durable with WAL
+                'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL',
+                # Take the write lock when a transaction starts, so concurrent writers wait for each
+                # other (up to the timeout, in seconds) instead of failing with "database is locked"
+                'transaction_mode': 'IMMEDIATE',
+                'timeout': float(os.environ.get("DB_TIMEOUT", 20)),
+            },
+        }
     }
-}
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': f'django.db.backends.{DB_ENGINE}',
+            'NAME': os.environ.get("DB_NAME", "broadcast"),
+            'USER': os.environ.get("DB_USER", ""),
+            'PASSWORD': os.environ.get("DB_PASSWORD", ""),
+            'HOST': os.environ.get("DB_HOST", ""),
+            'PORT': os.environ.get("DB_PORT", ""),
+            'CONN_MAX_AGE': int(os.environ.get("DB_CONN_MAX_AGE", 0)),
+            'OPTIONS': {},
+        }
+    }
+    # A connection pool (psycopg[pool]) replaces persistent connections, so CONN_MAX_AGE must stay 0
+    if int(os.environ.get("DB_POOL_MAX_SIZE", 0)):
+        DATABASES['default']['OPTIONS']['pool'] = {
+            'min_size': int(os.environ.get("DB_POOL_MIN_SIZE", 1)),
+            'max_size': int(os.environ.get("DB_POOL_MAX_SIZE")),
+        }
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -120,6 +153,10 @@ STATIC_URL = '/static/'
 STATICFILES_DIRS = [BASE_DIR / "static"]
 STATIC_ROOT = BASE_DIR / "staticfiles"
 
+# Images and videos uploaded for broadcasts; the workers read them from here for their first send
+MEDIA_URL = '/media/'
+MEDIA_ROOT = Path(os.environ.get("MEDIA_ROOT", BASE_DIR / "media"))
+
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
@@ -136,3 +173,37 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 10,
     'MAX_PAGE_SIZE': 100,
 }
+
+# Broadcast worker
+# Bot API server the workers send to; point it at a local Bot API server or a stand-in for benchmarks
+TELEGRAM_BOT_API_URL = os.environ.get("TELEGRAM_BOT_API_URL", "https://api.telegram.org")
+# Telegram allows about 30 messages per second overall and 1 message per second to the same chat
+BROADCAST_RATE_LIMIT = float(os.environ.get("BROADCAST_RATE_LIMIT", 30))
+BROADCAST_PER_CHAT_RATE_LIMIT = float(os.environ.get("BROADCAST_PER_CHAT_RATE_LIMIT", 1))
+# Per-recipient delivery state and the progress counters are written in the background once this many
+# messages are waiting or this many seconds have passed; a restarted worker resumes from the last write
+BROADCAST_COMMIT_SIZE = int(os.environ.get("BROADCAST_COMMIT_SIZE", 500))
+BROADCAST_COMMIT_INTERVAL = float(os.environ.get("BROADCAST_COMMIT_INTERVAL", 10))
+# Several worker processes may run at once; each paces itself at BROADCAST_RATE_LIMIT / BROADCAST_WORKER_PROCESSES
+BROADCAST_WORKER_PROCESSES = int(os.environ.get("BROADCAST_WORKER_PROCESSES", 1))
+BROADCAST_SHARD_SIZE = int(os.environ.get("BROADCAST_SHARD_SIZE", 10000))  # Recipients claimed by a worker at once
+BROADCAST_LEASE_SECONDS = int(os.environ.get("BROADCAST_LEASE_SECONDS", 120))  # Shard claims expire unless renewed
+# Shards of different broadcasts a worker sends side by side, sharing its rate limit by priority
+BROADCAST_ACTIVE_SHARDS = int(os.environ.get("BROADCAST_ACTIVE_SHARDS", 4))
+# Idle workers block on a socket in this directory and are woken when a broadcast is created;
+# BROADCAST_POLL_INTERVAL is the fallback when no wakeup arrives
+BROADCAST_WAKEUP_DIR = Path(os.environ.get("BROADCAST_WAKEUP_DIR", Path(tempfile.gettempdir()) / "broadcast-wakeup"))
+BROADCAST_POLL_INTERVAL = float(os.environ.get("BROADCAST_POLL_INTERVAL", 10))
+# Web processes streaming live progress bind a socket in this directory; workers publish counter
+# deltas to them at most once per BROADCAST_EVENTS_INTERVAL seconds
+BROADCAST_EVENTS_DIR = Path(os.environ.get("BROADCAST_EVENTS_DIR", Path(tempfile.gettempdir()) / "broadcast-events"))
+BROADCAST_EVENTS_INTERVAL = float(os.environ.get("BROADCAST_EVENTS_INTERVAL", 0.5))
+# Attempts after a transient failure (429, 5xx, network error) before a message counts as failed
+BROADCAST_MAX_RETRIES = int(os.environ.get("BROADCAST_MAX_RETRIES", 5))
+BROADCAST_PAGE_SIZE = int(os.environ.get("BROADCAST_PAGE_SIZE", 2000))  # Recipients read from the database per query
+# Each worker process serves Prometheus metrics on the first free port from this one (0 turns it off),
+# on this address only; set it to 0.0.0.0 for a scraper on another host
+BROADCAST_METRICS_PORT = int(os.environ.get("BROADCAST_METRICS_PORT", 9310))
+BROADCAST_METRICS_ADDR = os.environ.get("BROADCAST_METRICS_ADDR", "127.0.0.1")
+# When set, workers profile process_broadcast and send_message with cProfile and write the stats here on exit
+BROADCAST_PROFILE_DIR = os.environ.get("BROADCAST_PROFILE_DIR") or None
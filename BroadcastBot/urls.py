@@ -18,16 +18,21 @@ from django.contrib import admin
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
 
-from broadcast.views import UserViewSet, BroadcastViewSet, index
+from broadcast.views import UserViewSet, BroadcastViewSet, MediaViewSet, SegmentViewSet, index
+from broadcast_worker.views import metrics, progress_stream
 
 # Create a router and register the UserViewSet
 router = DefaultRouter()
 router.register(r'users', UserViewSet, basename='user')
 router.register(r'broadcasts', BroadcastViewSet, basename='broadcast')
+router.register(r'segments', SegmentViewSet, basename='segment')
+router.register(r'media', MediaViewSet, basename='media')
 
 urlpatterns = [
     path('', index, name='index'),
     path('admin/', admin.site.urls),
+    path('metrics', metrics, name='metrics'),
+    path('api/broadcasts/stream/', progress_stream, name='broadcast-stream'),  # Ahead of the router's detail route
     path('api/', include(router.urls)),  # Include the router-generated routes
 
 ]
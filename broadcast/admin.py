@@ -1,6 +1,8 @@
 from django.contrib import admin
+from django.db import transaction
 
-from broadcast.models import User, Broadcast
+from broadcast.models import Media, Segment, User, Broadcast
+from broadcast.segments import build_segment, refresh_segments
 
 
 # Register your models here.
@@ -8,12 +10,51 @@ from broadcast.models import User, Broadcast
 class UserAdmin(admin.ModelAdmin):
     list_display = ('telegram_id', 'blocked')
     search_fields = ('telegram_id',)
-    list_filter = ('blocked',)
+    list_filter = ('blocked', 'tags')
+
+    def save_related(self, request, form, formsets, change):
+        # After the tags are saved, which save_model is too early for
+        super().save_related(request, form, formsets, change)
+        refresh_segments(User.objects.filter(id=form.instance.id))
+
+    def delete_model(self, request, obj):
+        with transaction.atomic():
+            refresh_segments(User.objects.filter(id=obj.id), removed=True)
+            super().delete_model(request, obj)
+
+    def delete_queryset(self, request, queryset):
+        # Leaving its segments first, so their sizes drop with the members a cascade would delete
+        with transaction.atomic():
+            refresh_segments(queryset, removed=True)
+            super().delete_queryset(request, queryset)
 
 
 @admin.register(Broadcast)
 class BroadcastAdmin(admin.ModelAdmin):
-    list_display = ('id', 'message', 'type', 'buttons', 'file_id', 'created_at', 'status', 'total_target_users',
-                    'total_successful', 'total_failed', 'users')
+    list_display = ('id', 'message', 'type', 'buttons', 'file_id', 'created_at', 'status', 'priority',
+                    'scheduled_at', 'recurrence', 'total_target_users', 'total_successful', 'total_failed',
+                    'targeted', 'segment', 'media')
     search_fields = ('message',)
-    list_filter = ('status', 'created_at')
+    list_filter = ('status', 'priority', 'recurrence', 'created_at')
+
+
+@admin.register(Media)
+class MediaAdmin(admin.ModelAdmin):
+    list_display = ('id', 'filename', 'type', 'size', 'sha256', 'file_id', 'created_at')
+    search_fields = ('filename', 'sha256')
+    list_filter = ('type',)
+    readonly_fields = ('sha256', 'size', 'file_id', 'upload_expires_at', 'upload_worker')
+
+    def has_add_permission(self, request):
+        return False  # Uploaded through the API, which hashes and deduplicates it
+
+
+@admin.register(Segment)
+class SegmentAdmin(admin.ModelAdmin):
+    list_display = ('id', 'name', 'tags', 'attributes', 'version', 'size', 'refreshed_at', 'building', 'ad_hoc')
+    search_fields = ('name',)
+    readonly_fields = ('version', 'size', 'refreshed_at', 'building', 'ad_hoc')
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        build_segment(obj)
@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class BroadcastConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'broadcast'
+
+    def ready(self):
+        from broadcast import signals  # noqa: F401
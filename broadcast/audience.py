@@ -0,0 +1,101 @@
+import heapq
+import itertools
+import operator
+import sys
+from array import array
+from bisect import bisect_left
+
+INT64_MIN, INT64_MAX = -2 ** 63, 2 ** 63 - 1  # The range of a telegram id, as of BigIntegerField
+
+
+class RecipientSet:
+    """A set of telegram ids held as a sorted int64 array without duplicates.
+
+    Eight bytes per id instead of a Python int and a list slot each, and it converts to
+    and from the packed bytes it is stored as without parsing. Those are little-endian
+    whatever the machine, so a stored list reads the same on any worker. Set operations merge the
+    sorted arrays in one pass and never build an intermediate list or set.
+    """
+
+    __slots__ = ("ids",)
+
+    ITEM_SIZE = 8  # Bytes per packed id
+
+    def __init__(self, ids=None):
+        self.ids = ids if ids is not None else array("q")  # Must already be sorted and unique
+
+    @classmethod
+    def from_ids(cls, telegram_ids):
+        """Build a set from ids in any order, dropping duplicates."""
+        ids = array("q", telegram_ids)
+        if not all(map(operator.lt, ids, itertools.islice(ids, 1, None))):
+            ids = array("q", sorted(set(ids)))
+        return cls(ids)
+
+    @classmethod
+    def from_sorted(cls, telegram_ids):
+        """Build a set from ids in ascending order, e.g. a query ordered by telegram id, dropping repeats."""
+        return cls(array("q", dedupe(telegram_ids)))
+
+    @classmethod
+    def from_bytes(cls, data):
+        ids = array("q")
+        ids.frombytes(data)
+        if sys.byteorder == "big":
+            ids.byteswap()
+        return cls(ids)
+
+    def to_bytes(self):
+        if sys.byteorder == "big":
+            ids = array("q", self.ids)
+            ids.byteswap()
+            return ids.tobytes()
+        return self.ids.tobytes()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids)
+
+    def __contains__(self, telegram_id):
+        index = bisect_left(self.ids, telegram_id)
+        return index < len(self.ids) and self.ids[index] == telegram_id
+
+    def __eq__(self, other):
+        return isinstance(other, RecipientSet) and self.ids == other.ids
+
+    def union(self, *others):
+        """Return the ids in this set or any of ``others``."""
+        return RecipientSet(array("q", dedupe(heapq.merge(self.ids, *(other.ids for other in others)))))
+
+    def difference(self, other):
+        """Return the ids of this set that are not in ``other``, e.g. to exclude blocked or already sent users."""
+        if not other.ids or not self.ids:
+            return RecipientSet(array("q", self.ids))
+        result = array("q")
+        excluded = iter(other.ids)
+        next_excluded = next(excluded)
+        for telegram_id in self.ids:
+            while next_excluded < telegram_id:
+                next_excluded = next(excluded, None)
+                if next_excluded is None:
+                    result.extend(self.ids[bisect_left(self.ids, telegram_id):])
+                    return RecipientSet(result)
+            if telegram_id != next_excluded:
+                result.append(telegram_id)
+        return RecipientSet(result)
+
+    def intersection(self, other):
+        """Return the ids in both sets."""
+        small, large = sorted((self, other), key=len)
+        return RecipientSet(array("q", (telegram_id for telegram_id in small.ids if telegram_id in large)))
+
+
+def dedupe(sorted_ids):
+    """Yield ascending ids once each."""
+    last = None
+    for telegram_id in sorted_ids:
+        if telegram_id != last:
+            yield telegram_id
+            last = telegram_id
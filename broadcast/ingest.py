@@ -0,0 +1,200 @@
+import csv
+import itertools
+import json
+import re
+
+from django.db import transaction
+
+from broadcast.audience import INT64_MAX, INT64_MIN
+from broadcast.models import Tag, User
+from broadcast.segments import refresh_segments
+
+CHUNK_SIZE = 5000  # Rows upserted per round of queries
+INTEGER = re.compile(r"^[+-]?[0-9]+$")
+TAG = re.compile(r"^[-a-zA-Z0-9_]{1,64}$")
+ATTRIBUTE_KEY = re.compile(r"^[A-Za-z][A-Za-z0-9_]{0,63}$")
+
+
+def parse_ndjson(lines):
+    """Yield ``(telegram_id, blocked, tags, attributes)`` from NDJSON byte lines; a field not given is None.
+
+    Lines that are not a valid user yield None so the caller can count them.
+    """
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield parse_user(json.loads(line))
+        except (ValueError, TypeError, KeyError):
+            yield None
+
+
+def parse_csv(lines):
+    """Yield users as ``parse_ndjson`` does from CSV byte lines, with or without a header.
+
+    The columns are ``telegram_id,blocked,tags,attributes``, all but the first optional:
+    ``tags`` separated by spaces and ``attributes`` a JSON object.
+    """
+    for row in csv.reader(line.decode("utf-8") for line in lines):
+        if not row or row[0].strip() == "telegram_id":
+            continue
+        row += [""] * (4 - len(row))
+        try:
+            yield (
+                parse_telegram_id(row[0]),
+                parse_blocked(row[1]),
+                parse_tags(row[2].split()) if row[2].strip() else None,
+                parse_attributes(json.loads(row[3])) if row[3].strip() else None,
+            )
+        except ValueError:
+            yield None
+
+
+def parse_json(data):
+    """Yield users as ``parse_ndjson`` does from an already parsed JSON list of ids or user objects."""
+    for row in data if isinstance(data, list) else []:
+        try:
+            if isinstance(row, dict):
+                yield parse_user(row)
+            else:
+                yield parse_telegram_id(row), None, None, None
+        except (ValueError, TypeError, KeyError):
+            yield None
+
+
+def parse_user(row):
+    tags, attributes = row.get("tags"), row.get("attributes")
+    return (
+        parse_telegram_id(row["telegram_id"]),
+        parse_blocked(row.get("blocked")),
+        None if tags is None else parse_tags(tags),
+        None if attributes is None else parse_attributes(attributes),
+    )
+
+
+def parse_telegram_id(value):
+    """Return a telegram id given as an integer or a string of digits. Raise ValueError for anything else.
+
+    Floats and booleans are refused rather than truncated, and so are ids outside the 64-bit range.
+    """
+    if isinstance(value, str) and INTEGER.match(value.strip()):
+        value = int(value)
+    if type(value) is not int or not INT64_MIN <= value <= INT64_MAX:
+        raise ValueError(value)
+    return value
+
+
+def parse_blocked(value):
+    if value is None or value == "":
+        return None
+    if isinstance(value, str):
+        value = value.strip().lower()
+        if value not in ("true", "false", "1", "0"):
+            raise ValueError(value)
+        return value in ("true", "1")
+    return bool(value)
+
+
+def parse_tags(value):
+    """Return a list of tag names, as the users API takes them. Raise ValueError for anything else."""
+    if not isinstance(value, list) or not all(isinstance(name, str) and TAG.match(name) for name in value):
+        raise ValueError(value)
+    return sorted(set(value))
+
+
+def parse_attributes(value):
+    """Return a flat object of attribute values, as segments match them. Raise ValueError for anything else."""
+    if not isinstance(value, dict):
+        raise ValueError("Expected an object of attribute values")
+    for key, item in value.items():
+        if not ATTRIBUTE_KEY.match(key) or "__" in key:
+            raise ValueError(f"Invalid attribute name: {key!r}")
+        if item is not None and not isinstance(item, (str, int, float, bool)):
+            raise ValueError(f"Attribute {key!r} must be a string, number, boolean or null")
+    return value
+
+
+def import_users(rows):
+    """Upsert users from ``(telegram_id, blocked, tags, attributes)`` rows, one short transaction per chunk.
+
+    New ids are inserted. Existing ones are updated only where a given ``blocked``, tag list or
+    attributes object differs from what is stored, a field given as None being left as it is,
+    and everything else is skipped. Returns the counts of each. Segments are brought up to date
+    for the users inserted or updated. Committing per chunk keeps a long upload from holding
+    the database's write lock against the workers; an upload that fails part way keeps the
+    chunks before it, and can simply be repeated.
+    """
+    counts = {"inserted": 0, "updated": 0, "skipped": 0, "invalid": 0}
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, CHUNK_SIZE))
+        if not chunk:
+            break
+        with transaction.atomic():
+            incoming = {}
+            for row in chunk:
+                if row is None:
+                    counts["invalid"] += 1
+                    continue
+                if row[0] in incoming:
+                    counts["skipped"] += 1  # Repeated within the chunk; the last value wins
+                incoming[row[0]] = row[1:]
+
+            existing = {telegram_id: (user_id, blocked, attributes) for telegram_id, user_id, blocked, attributes
+                        in User.objects.filter(telegram_id__in=incoming)
+                        .values_list("telegram_id", "id", "blocked", "attributes")}
+            inserted = [telegram_id for telegram_id in incoming if telegram_id not in existing]
+            User.objects.bulk_create([User(telegram_id=telegram_id, blocked=bool(incoming[telegram_id][0]),
+                                           attributes=incoming[telegram_id][2] or {})
+                                      for telegram_id in inserted], ignore_conflicts=True)
+            counts["inserted"] += len(inserted)
+
+            updated = set()
+            for blocked in (True, False):
+                changed = [telegram_id for telegram_id, (value, _, _) in incoming.items()
+                           if telegram_id in existing and value == blocked and existing[telegram_id][1] != blocked]
+                if changed:
+                    User.objects.filter(telegram_id__in=changed).update(blocked=blocked)
+                    updated.update(changed)
+            changed = {telegram_id: attributes for telegram_id, (_, _, attributes) in incoming.items()
+                       if telegram_id in existing and attributes is not None
+                       and canonical(attributes) != canonical(existing[telegram_id][2])}
+            User.objects.bulk_update([User(id=existing[telegram_id][0], attributes=attributes)
+                                      for telegram_id, attributes in changed.items()], ["attributes"])
+            updated.update(changed)
+            updated.update(set_tags({telegram_id: tags for telegram_id, (_, tags, _) in incoming.items()
+                                     if tags is not None}, existing))
+            counts["updated"] += len(updated)
+            counts["skipped"] += len(existing) - len(updated)
+            refresh_segments(User.objects.filter(telegram_id__in=inserted + list(updated)))
+    return counts
+
+
+def canonical(attributes):
+    # As stored: 1 and True are different values, and key order does not matter
+    return json.dumps(attributes or {}, sort_keys=True)
+
+
+def set_tags(tags, existing):
+    """Give each user in ``tags`` (telegram id -> names) exactly those tags. Return the existing ids changed."""
+    if not tags:
+        return []
+    user_ids = dict(User.objects.filter(telegram_id__in=tags).values_list("telegram_id", "id"))
+    current = {telegram_id: set() for telegram_id in user_ids}
+    telegram_ids = {user_id: telegram_id for telegram_id, user_id in user_ids.items()}
+    for user_id, name in User.tags.through.objects.filter(user_id__in=telegram_ids).values_list("user_id", "tag__name"):
+        current[telegram_ids[user_id]].add(name)
+    changed = [telegram_id for telegram_id, names in current.items() if set(tags[telegram_id]) != names]
+    if not changed:
+        return []
+
+    names = {name for telegram_id in changed for name in tags[telegram_id]}
+    Tag.objects.bulk_create([Tag(name=name) for name in names], ignore_conflicts=True)
+    tag_ids = dict(Tag.objects.filter(name__in=names).values_list("name", "id"))
+    User.tags.through.objects.filter(user_id__in=[user_ids[telegram_id] for telegram_id in changed]).delete()
+    User.tags.through.objects.bulk_create([
+        User.tags.through(user_id=user_ids[telegram_id], tag_id=tag_ids[name])
+        for telegram_id in changed for name in tags[telegram_id]
+    ])
+    return [telegram_id for telegram_id in changed if telegram_id in existing]
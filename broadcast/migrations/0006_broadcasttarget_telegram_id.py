@@ -0,0 +1,29 @@
+# Generated by Django 5.1.4 on 2026-10-18 09:12
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('broadcast', '0005_broadcast_buttons_broadcast_file_id_broadcast_type'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='broadcasttarget',
+            name='telegram_id',
+            field=models.BigIntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.AlterField(
+            model_name='broadcasttarget',
+            name='user',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='broadcasts', to='broadcast.user'),
+        ),
+        migrations.AddConstraint(
+            model_name='broadcasttarget',
+            constraint=models.UniqueConstraint(fields=('broadcast', 'telegram_id'), name='unique_broadcast_target'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 16:42
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('broadcast', '0006_broadcasttarget_telegram_id'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='user',
+            name='blocked',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+    ]
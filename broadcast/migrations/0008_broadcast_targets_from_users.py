@@ -0,0 +1,59 @@
+# Generated by Django 5.1.4 on 2026-10-18 16:44
+
+from django.db import migrations, models
+
+
+def users_to_targets(apps, schema_editor):
+    """Move each explicit audience from the users JSON list into BroadcastTarget rows."""
+    Broadcast = apps.get_model('broadcast', 'Broadcast')
+    BroadcastTarget = apps.get_model('broadcast', 'BroadcastTarget')
+    BroadcastShard = apps.get_model('broadcast_worker', 'BroadcastShard')
+
+    for broadcast in Broadcast.objects.exclude(users=None).iterator():
+        telegram_ids = []
+        for telegram_id in broadcast.users or []:
+            try:
+                telegram_ids.append(int(telegram_id))
+            except (TypeError, ValueError):
+                continue
+        if not telegram_ids:
+            continue
+        broadcast.targeted = True
+        broadcast.save(update_fields=['targeted'])
+        if broadcast.status == 'completed':
+            continue  # Nothing is left to send; its recorded deliveries are all there is
+        # Rows already recorded by the worker keep their status; the rest become pending
+        BroadcastTarget.objects.bulk_create(
+            [BroadcastTarget(broadcast_id=broadcast.id, telegram_id=telegram_id) for telegram_id in telegram_ids],
+            batch_size=5000,
+            ignore_conflicts=True,
+        )
+
+    # Shards of unfinished explicit audiences were list positions; let the worker plan them again by target id
+    BroadcastShard.objects.filter(broadcast__targeted=True).exclude(broadcast__status='completed').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('broadcast', '0007_user_blocked_index'),
+        ('broadcast_worker', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='broadcast',
+            name='targeted',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(users_to_targets, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='broadcast',
+            name='users',
+        ),
+        migrations.AlterField(
+            model_name='broadcast',
+            name='status',
+            field=models.CharField(choices=[('draft', 'Draft'), ('pending', 'Pending'), ('inprogress', 'In Progress'), ('completed', 'Completed')], default='pending', max_length=10),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.1.4 on 2026-10-18 16:52
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('broadcast', '0008_broadcast_targets_from_users'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='broadcast',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.1.4 on 2026-10-18 17:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('broadcast', '0009_broadcast_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='broadcast',
+            index=models.Index(fields=['status', 'created_at'], name='broadcast_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='broadcast',
+            index=models.Index(fields=['created_at'], name='broadcast_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='broadcasttarget',
+            index=models.Index(fields=['broadcast', 'status', 'id'], name='target_broadcast_status_idx'),
+        ),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.1.4 on 2026-10-18 17:22
+
+import sys
+from array import array
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def targets_to_recipient_lists(apps, schema_editor):
+    """Pack the audience of each unfinished targeted broadcast into a RecipientList."""
+    Broadcast = apps.get_model('broadcast', 'Broadcast')
+    BroadcastTarget = apps.get_model('broadcast', 'BroadcastTarget')
+    RecipientList = apps.get_model('broadcast', 'RecipientList')
+    BroadcastShard = apps.get_model('broadcast_worker', 'BroadcastShard')
+
+    for broadcast in Broadcast.objects.filter(targeted=True).exclude(status='completed').iterator():
+        # Targets the worker already recorded stay as they are and are skipped when sending
+        telegram_ids = array('q', BroadcastTarget.objects.filter(broadcast_id=broadcast.id)
+                             .order_by('telegram_id').values_list('telegram_id', flat=True).iterator())
+        if sys.byteorder == 'big':
+            telegram_ids.byteswap()  # Stored little-endian, as RecipientSet packs it
+        RecipientList.objects.create(broadcast_id=broadcast.id, ids=telegram_ids.tobytes(), size=len(telegram_ids))
+        BroadcastTarget.objects.filter(broadcast_id=broadcast.id, status='pending').delete()
+
+    # Shards of unfinished explicit audiences were target id ranges; let the worker plan them again by position
+    BroadcastShard.objects.filter(broadcast__targeted=True).exclude(broadcast__status='completed').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('broadcast', '0012_segments'),
+        ('broadcast_worker', '0002_shard_status_lease_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecipientList',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('ids', models.BinaryField()),
+                ('size', models.PositiveIntegerField()),
+                ('merged', models.BooleanField(default=False)),
+                ('broadcast', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='recipient_lists', to='broadcast.broadcast')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(condition=models.Q(('merged', True)), fields=('broadcast',), name='unique_merged_recipient_list')],
+            },
+        ),
+        migrations.RunPython(targets_to_recipient_lists, migrations.RunPython.noop),
+    ]
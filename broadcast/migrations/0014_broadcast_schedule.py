@@ -0,0 +1,32 @@
+# Generated by Django 5.1.4 on 2026-10-18 17:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('broadcast', '0013_recipient_lists'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='broadcast',
+            name='delivery_window',
+            field=models.DurationField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='broadcast',
+            name='recurrence',
+            field=models.CharField(blank=True, choices=[('', 'None'), ('hourly', 'Hourly'), ('daily', 'Daily'), ('weekly', 'Weekly')], default='', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='broadcast',
+            name='scheduled_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='broadcast',
+            index=models.Index(fields=['status', 'scheduled_at'], name='broadcast_status_scheduled_idx'),
+        ),
+    ]
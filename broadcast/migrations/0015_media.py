@@ -0,0 +1,35 @@
+# Generated by Django 5.1.4 on 2026-10-18 17:35
+
+import broadcast.models
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('broadcast', '0014_broadcast_schedule'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Media',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('type', models.CharField(choices=[('image', 'Image'), ('video', 'Video')], max_length=20)),
+                ('file', models.FileField(upload_to=broadcast.models.media_path)),
+                ('filename', models.CharField(blank=True, max_length=255)),
+                ('content_type', models.CharField(blank=True, max_length=100)),
+                ('size', models.PositiveBigIntegerField()),
+                ('file_id', models.CharField(blank=True, max_length=255, null=True)),
+                ('upload_expires_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='broadcast',
+            name='media',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='broadcasts', to='broadcast.media'),
+        ),
+    ]
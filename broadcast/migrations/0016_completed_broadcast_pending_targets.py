@@ -0,0 +1,24 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:05
+
+from django.db import migrations
+
+
+def delete_pending_targets(apps, schema_editor):
+    """Delete the pending targets 0008 created for broadcasts that had already been sent.
+
+    The worker only records sent and failed deliveries, so on a completed broadcast a
+    pending target is a recipient that was never going to be sent to.
+    """
+    BroadcastTarget = apps.get_model('broadcast', 'BroadcastTarget')
+    BroadcastTarget.objects.filter(status='pending', broadcast__status='completed').delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('broadcast', '0015_media'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_pending_targets, migrations.RunPython.noop),
+    ]
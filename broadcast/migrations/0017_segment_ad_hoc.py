@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 17:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('broadcast', '0016_completed_broadcast_pending_targets'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='segment',
+            name='ad_hoc',
+            field=models.BooleanField(default=False),
+        ),
+    ]
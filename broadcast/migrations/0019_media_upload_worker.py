@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('broadcast', '0018_counter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='media',
+            name='upload_worker',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 18:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('broadcast', '0019_media_upload_worker'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='segment',
+            name='building',
+            field=models.BooleanField(default=False),
+        ),
+    ]
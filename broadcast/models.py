@@ -1,18 +1,122 @@
-from django.db import models
+import json
+import os
+from datetime import timedelta
+
+from django.db import IntegrityError, models, transaction
+
+from broadcast.audience import RecipientSet
+
+
+class Tag(models.Model):
+    name = models.CharField(max_length=64, unique=True)
+
+    def __str__(self):
+        return self.name
 
 
 class User(models.Model):
     telegram_id = models.BigIntegerField(unique=True)
-    blocked = models.BooleanField(default=False)
+    blocked = models.BooleanField(default=False, db_index=True)  # Set by the worker when Telegram reports it
+    tags = models.ManyToManyField(Tag, blank=True, related_name='users')
+    attributes = models.JSONField(default=dict, blank=True)  # Flat key -> scalar value, matched by segments
+
+
+class Segment(models.Model):
+    # An audience of every non-blocked user with all of ``tags`` and the given ``attributes`` values.
+    # Its members are materialized as SegmentMember rows, kept up to date as users change and
+    # shared by every broadcast sent to it; ``size`` is their count
+    name = models.CharField(max_length=255, blank=True)
+    tags = models.JSONField(default=list, blank=True)
+    attributes = models.JSONField(default=dict, blank=True)
+    key = models.CharField(max_length=1024, db_index=True, editable=False)  # Canonical filter, to reuse a segment
+    version = models.PositiveIntegerField(default=0)  # Bumped whenever the members change
+    size = models.PositiveIntegerField(default=0)
+    refreshed_at = models.DateTimeField(null=True, blank=True)  # Last full rebuild; null until first built
+    building = models.BooleanField(default=False)  # A rebuild is under way; members are kept up to date meanwhile
+    # Created for a broadcast's segment_filter; its members are dropped once no unfinished broadcast is sent to it
+    ad_hoc = models.BooleanField(default=False)
+
+    def __str__(self):
+        return self.name or self.key
+
+    @staticmethod
+    def filter_key(tags, attributes):
+        return json.dumps({'tags': sorted(set(tags)), 'attributes': attributes}, sort_keys=True, separators=(',', ':'))
+
+    def save(self, *args, **kwargs):
+        self.tags = sorted(set(self.tags))
+        self.key = self.filter_key(self.tags, self.attributes)
+        super().save(*args, **kwargs)
+
+
+class SegmentMember(models.Model):
+    segment = models.ForeignKey(Segment, on_delete=models.CASCADE, related_name='members')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='segment_memberships')
+
+    class Meta:
+        constraints = [
+            # Also the index a shard's recipients are read through, in user id order
+            models.UniqueConstraint(fields=['segment', 'user'], name='unique_segment_member'),
+        ]
+
+
+def media_path(instance, filename):
+    return f'broadcast_media/{instance.sha256}{os.path.splitext(filename)[1].lower()}'
+
+
+class Media(models.Model):
+    # An image or video uploaded once through the API and shared by any number of broadcasts, one per content.
+    # The first send uploads the file to Telegram and keeps the file_id it returns; every later send, of
+    # any broadcast, goes by that file_id
+    MEDIA_TYPE = [
+        ('image', 'Image'),
+        ('video', 'Video'),
+    ]
+    MAX_SIZES = {'image': 10 * 1024 * 1024, 'video': 50 * 1024 * 1024}  # What the Bot API accepts as an upload
+
+    sha256 = models.CharField(max_length=64, unique=True)  # Hex digest of the content
+    type = models.CharField(max_length=20, choices=MEDIA_TYPE)
+    file = models.FileField(upload_to=media_path)
+    filename = models.CharField(max_length=255, blank=True)
+    content_type = models.CharField(max_length=100, blank=True)
+    size = models.PositiveBigIntegerField()
+    file_id = models.CharField(max_length=255, null=True, blank=True)  # Set by the worker after the first upload
+    upload_expires_at = models.DateTimeField(null=True, blank=True)  # A worker is uploading it until then
+    upload_worker = models.CharField(max_length=255, blank=True, default='')  # The worker uploading it
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return self.filename or self.sha256
 
 
 class Broadcast(models.Model):
     STATUS_CHOICES = [
+        ('draft', 'Draft'),  # Recipients are still being uploaded; workers ignore it
         ('pending', 'Pending'),
         ('inprogress', 'In Progress'),
         ('completed', 'Completed'),
     ]
 
+    # Concurrent broadcasts share a worker's rate limit in proportion to 2 ** priority
+    PRIORITY_CHOICES = [
+        (0, 'Low'),
+        (1, 'Normal'),
+        (2, 'High'),
+        (3, 'Urgent'),
+    ]
+
+    RECURRENCE_CHOICES = [
+        ('', 'None'),
+        ('hourly', 'Hourly'),
+        ('daily', 'Daily'),
+        ('weekly', 'Weekly'),
+    ]
+    RECURRENCE_INTERVALS = {
+        'hourly': timedelta(hours=1),
+        'daily': timedelta(days=1),
+        'weekly': timedelta(weeks=1),
+    }
+
     MESSAGE_TYPE = [
         ('text', 'Text'),
         ('image', 'Image'),
@@ -22,16 +126,106 @@ class Broadcast(models.Model):
     message = models.TextField()
     buttons = models.JSONField(default=list)
     file_id = models.CharField(max_length=255, null=True, blank=True)
+    media = models.ForeignKey(Media, on_delete=models.PROTECT, related_name='broadcasts', null=True, blank=True)
     type = models.CharField(max_length=20, choices=MESSAGE_TYPE, default='text')
     created_at = models.DateTimeField(auto_now_add=True)
+    # Part of the progress ETag: bumped by the worker's progress writes, and must be in every partial save()
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
     total_target_users = models.PositiveIntegerField(default=0)  # Total users targeted
     total_successful = models.PositiveIntegerField(default=0)  # Users reached
     total_failed = models.PositiveIntegerField(default=0)  # Users not reached
-    users = models.JSONField(null=True, blank=True)
+    targeted = models.BooleanField(default=False)  # Sent to its RecipientLists instead of every User
+    priority = models.PositiveSmallIntegerField(choices=PRIORITY_CHOICES, default=1)
+    # Sent to the members of a segment instead of every User; the version is the one it was planned against
+    segment = models.ForeignKey(Segment, on_delete=models.PROTECT, related_name='broadcasts', null=True, blank=True)
+    segment_version = models.PositiveIntegerField(null=True, blank=True)
+    scheduled_at = models.DateTimeField(null=True, blank=True)  # Not sent before this time; null sends right away
+    # Once planned, a recurring broadcast queues a copy of itself for its next scheduled time
+    recurrence = models.CharField(max_length=10, choices=RECURRENCE_CHOICES, blank=True, default='')
+    # Spread the sends evenly over this long instead of sending as fast as the rate limit allows
+    delivery_window = models.DurationField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # The worker's next broadcast and the list API's status filter, both ordered by creation
+            models.Index(fields=['status', 'created_at'], name='broadcast_status_created_idx'),
+            models.Index(fields=['created_at'], name='broadcast_created_idx'),
+            # The worker's next scheduled broadcast, to sleep until it is due
+            models.Index(fields=['status', 'scheduled_at'], name='broadcast_status_scheduled_idx'),
+        ]
+
+    def add_recipients(self, telegram_ids):
+        """Add a list of telegram ids to the explicit audience. Return the number of distinct ids in it.
+
+        The list is stored as one packed ``RecipientList``; ids repeated across lists are
+        dropped when the worker merges them.
+        """
+        recipients = RecipientSet.from_ids(telegram_ids)
+        RecipientList.objects.create(broadcast=self, ids=recipients.to_bytes(), size=len(recipients))
+        if not self.targeted:
+            self.targeted = True
+            self.save(update_fields=['targeted', 'updated_at'])
+        return len(recipients)
+
+    def merged_recipients(self):
+        """Return the explicit audience as one ``RecipientSet``, merging the uploaded lists the first time."""
+        merged = RecipientList.objects.filter(broadcast=self, merged=True).values_list('ids', flat=True).first()
+        if merged is not None:
+            return RecipientSet.from_bytes(merged)
+        lists = RecipientList.objects.filter(broadcast=self, merged=False).values_list('ids', flat=True)
+        recipients = RecipientSet().union(*(RecipientSet.from_bytes(ids) for ids in lists))
+        try:
+            with transaction.atomic():
+                RecipientList.objects.create(broadcast=self, ids=recipients.to_bytes(), size=len(recipients), merged=True)
+                RecipientList.objects.filter(broadcast=self, merged=False).delete()
+        except IntegrityError:
+            return self.merged_recipients()  # Another worker merged them first
+        return recipients
+
+    def schedule_next(self, now):
+        """Queue the next occurrence of a recurring broadcast, skipping any that were missed. Return it."""
+        interval = self.RECURRENCE_INTERVALS[self.recurrence]
+        scheduled_at = (self.scheduled_at or now) + interval
+        if scheduled_at <= now:
+            scheduled_at += interval * ((now - scheduled_at) // interval + 1)
+        occurrence = Broadcast.objects.create(
+            message=self.message, buttons=self.buttons, file_id=self.file_id, media_id=self.media_id, type=self.type,
+            priority=self.priority, targeted=self.targeted, segment_id=self.segment_id, scheduled_at=scheduled_at,
+            recurrence=self.recurrence, delivery_window=self.delivery_window,
+        )
+        RecipientList.objects.bulk_create([
+            RecipientList(broadcast=occurrence, ids=ids, size=size, merged=merged)
+            for ids, size, merged in self.recipient_lists.values_list('ids', 'size', 'merged')
+        ])
+        return occurrence
+
+
+class RecipientList(models.Model):
+    # Telegram ids of an explicit audience, sorted, deduplicated and packed as int64 (RecipientSet).
+    # Each upload is one list; the worker merges a broadcast's lists into a single merged one when it
+    # plans it, and reads each shard as a byte range of that, so no list is ever parsed into Python ints
+    broadcast = models.ForeignKey(Broadcast, on_delete=models.CASCADE, related_name='recipient_lists')
+    ids = models.BinaryField()  # Little-endian whatever the machine, so a stored list reads the same on any worker
+    size = models.PositiveIntegerField()
+    merged = models.BooleanField(default=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['broadcast'], condition=models.Q(merged=True),
+                                    name='unique_merged_recipient_list'),
+        ]
+
+
+class Counter(models.Model):
+    # A named count kept in the database, so every web and worker process sees the same value;
+    # e.g. the broadcast deletions that are part of the progress ETag
+    name = models.CharField(max_length=64, unique=True)
+    value = models.PositiveBigIntegerField(default=0)
 
 
 class BroadcastTarget(models.Model):
+    # The recorded delivery to one recipient; written by the worker as it sends
     STATUS_CHOICES = [
         ('pending', 'Pending'),
         ('sent', 'Sent'),
@@ -39,6 +233,16 @@ class BroadcastTarget(models.Model):
     ]
 
     broadcast = models.ForeignKey(Broadcast, on_delete=models.CASCADE, related_name='targets')
-    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='broadcasts')
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='broadcasts', null=True, blank=True)
+    telegram_id = models.BigIntegerField()  # Recipient chat, also set for ids that have no User row
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
     sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['broadcast', 'telegram_id'], name='unique_broadcast_target'),
+        ]
+        indexes = [
+            # A broadcast's deliveries by status
+            models.Index(fields=['broadcast', 'status', 'id'], name='target_broadcast_status_idx'),
+        ]
@@ -0,0 +1,9 @@
+from rest_framework.pagination import CursorPagination
+
+
+class ProgressPagination(CursorPagination):
+    """Keyset pagination for progress polling: newest first and no COUNT(*) per page."""
+    ordering = '-id'
+    page_size = 10
+    page_size_query_param = 'limit'
+    max_page_size = 100
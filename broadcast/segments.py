@@ -0,0 +1,166 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Count, F, Q
+from django.db.models.fields.json import KeyTransform
+from django.utils import timezone
+
+from broadcast.models import Broadcast, Segment, SegmentMember, User
+
+CHUNK_SIZE = 5000  # Users compared per transaction when a segment is rebuilt
+
+
+def matching_users(segment):
+    """Return the users that belong in ``segment``: not blocked, with all of its tags and attribute values."""
+    users = User.objects.filter(blocked=False)
+    for tag in segment.tags:
+        users = users.filter(tags__name=tag)  # One join per tag, so a user needs every one
+    for index, (key, value) in enumerate(sorted(segment.attributes.items())):
+        # A key transform rather than ``attributes__<key>``, so keys never read as lookups
+        alias = f"attribute_{index}"
+        users = users.alias(**{alias: KeyTransform(key, "attributes")}).filter(**{alias: value})
+    return users
+
+
+def matches(segment, tag_names, attributes):
+    """Return whether a user with ``tag_names`` and ``attributes`` belongs in ``segment``; ``matching_users`` for one user.
+
+    Blocked users belong in no segment; the caller checks that.
+    """
+    return set(segment.tags) <= tag_names and all(
+        key in attributes and same_value(attributes[key], value) for key, value in segment.attributes.items()
+    )
+
+
+def same_value(a, b):
+    # As the database compares JSON values: a boolean only equals a boolean, and 1 equals 1.0
+    if isinstance(a, bool) or isinstance(b, bool):
+        return a is b
+    return a == b
+
+
+def get_segment(tags, attributes):
+    """Return the segment for a filter, creating it if no broadcast or user has asked for it before.
+
+    A new segment is built the first time a worker plans a broadcast for it.
+    """
+    key = Segment.filter_key(tags, attributes)
+    segment = Segment.objects.filter(key=key).order_by("id").first()
+    if segment is None:
+        segment = Segment.objects.create(tags=tags, attributes=attributes, ad_hoc=True)
+    return segment
+
+
+def build_segment(segment):
+    """Materialize the members of ``segment`` from scratch and start a new version of it.
+
+    Users are walked in id order ``CHUNK_SIZE`` at a time, each chunk in a transaction of its
+    own that writes only the difference between its members and the users that ``matches``
+    it, so a large segment never holds the write lock for long. While it is under way the segment is
+    marked ``building`` and kept up to date by ``refresh_segments`` like a built one; at the
+    end its size is counted again and the rebuild takes effect as a new version.
+    """
+    Segment.objects.filter(id=segment.id).update(building=True)
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            users = list(User.objects.filter(id__gt=last_id).order_by("id").values_list("id", "blocked", "attributes")
+                         [:CHUNK_SIZE])
+            if not users:
+                break
+            first, last = last_id + 1, users[-1][0]
+            tag_names = defaultdict(set)
+            if segment.tags:
+                tags = User.tags.through.objects.filter(user_id__gte=first, user_id__lte=last)
+                for user_id, name in tags.values_list("user_id", "tag__name"):
+                    tag_names[user_id].add(name)
+            matching = {user_id for user_id, blocked, attributes in users
+                        if not blocked and matches(segment, tag_names[user_id], attributes or {})}
+            members = SegmentMember.objects.filter(segment=segment, user_id__gte=first, user_id__lte=last)
+            current = set(members.values_list("user_id", flat=True))
+            joined, left = matching - current, current - matching
+            if joined or left:
+                SegmentMember.objects.bulk_create([SegmentMember(segment=segment, user_id=user_id) for user_id in joined])
+                members.filter(user_id__in=left).delete()
+                Segment.objects.filter(id=segment.id).update(
+                    size=F("size") + len(joined) - len(left),
+                    version=F("version") + 1,
+                )
+        last_id = last
+    with transaction.atomic():
+        size = SegmentMember.objects.filter(segment=segment).aggregate(size=Count("id"))["size"]
+        Segment.objects.filter(id=segment.id).update(
+            size=size, version=F("version") + 1, refreshed_at=timezone.now(), building=False,
+        )
+    segment.refresh_from_db(fields=["size", "version", "refreshed_at", "building"])
+    return segment
+
+
+def ensure_built(segment):
+    """Build ``segment`` if it never has been. Return it with its current version and size."""
+    if segment.refreshed_at is None:
+        return build_segment(segment)
+    return segment
+
+
+def release_segment(segment_id):
+    """Drop the members of an ad hoc segment no unfinished broadcast is sent to.
+
+    It is no longer kept up to date as users change, and is built again if a broadcast is
+    planned for it, so ad hoc filters that are never used again cost user writes nothing.
+    """
+    unfinished = Broadcast.objects.filter(segment=segment_id, status__in=["draft", "pending", "inprogress"])
+    with transaction.atomic():
+        released = (
+            Segment.objects
+            .filter(id=segment_id, ad_hoc=True)
+            .exclude(refreshed_at=None)
+            .exclude(building=True)
+            .exclude(id__in=unfinished.values("segment"))
+            .update(refreshed_at=None, size=0, version=F("version") + 1)
+        )
+        if released:
+            SegmentMember.objects.filter(segment=segment_id).delete()
+
+
+def refresh_segments(users, removed=False):
+    """Bring every built segment, or one being built, up to date for a few changed users.
+
+    ``users`` is a queryset of the users that were created, edited or flagged as blocked,
+    or that are about to be deleted (``removed``). Their memberships are worked out with
+    ``matches`` from one read of their tags and attributes, so the queries do not grow with
+    the number of segments; only a segment whose members change is written, with a new
+    version and an adjusted ``size`` so its count never has to be taken again. Call it in
+    the transaction that changed them.
+    """
+    changed = list(users.values_list("id", "blocked", "attributes"))
+    if not changed:
+        return
+    segments = list(
+        Segment.objects.filter(Q(refreshed_at__isnull=False) | Q(building=True)).only("id", "tags", "attributes")
+    )
+    if not segments:
+        return
+    user_ids = [user_id for user_id, _, _ in changed]
+    tag_names = defaultdict(set)
+    for user_id, name in User.tags.through.objects.filter(user_id__in=user_ids).values_list("user_id", "tag__name"):
+        tag_names[user_id].add(name)
+    current = set(SegmentMember.objects.filter(user_id__in=user_ids).values_list("segment_id", "user_id"))
+
+    for segment in segments:
+        joined, left = [], []
+        for user_id, blocked, attributes in changed:
+            member = (segment.id, user_id) in current
+            belongs = not removed and not blocked and matches(segment, tag_names[user_id], attributes or {})
+            if belongs and not member:
+                joined.append(user_id)
+            elif member and not belongs:
+                left.append(user_id)
+        if not joined and not left:
+            continue
+        SegmentMember.objects.bulk_create([SegmentMember(segment=segment, user_id=user_id) for user_id in joined])
+        SegmentMember.objects.filter(segment=segment, user_id__in=left).delete()
+        Segment.objects.filter(id=segment.id).update(
+            size=F("size") + len(joined) - len(left),
+            version=F("version") + 1,
+        )
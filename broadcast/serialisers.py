@@ -1,16 +1,158 @@
+from django.db import transaction
 from rest_framework import serializers
 
-from .models import User, Broadcast
+from .ingest import parse_attributes, parse_telegram_id
+from .models import Media, Segment, Tag, User, Broadcast
+from .segments import build_segment, get_segment, refresh_segments
+
+
+def validate_attributes(value):
+    # The same attributes the bulk import accepts
+    try:
+        return parse_attributes(value)
+    except ValueError as e:
+        raise serializers.ValidationError(str(e))
+
+
+class TagListField(serializers.ListField):
+    child = serializers.SlugField(max_length=64)
+
+    def to_representation(self, value):
+        return sorted(tag.name for tag in value.all())
+
+
+class TelegramIdField(serializers.IntegerField):
+    # The same ids the bulk import accepts: no floats or booleans taken for integers
+    def to_internal_value(self, data):
+        try:
+            return parse_telegram_id(data)
+        except ValueError:
+            self.fail('invalid')
 
 
 class UserSerializer(serializers.ModelSerializer):
+    tags = TagListField(required=False)
+
     class Meta:
         model = User
-        fields = ['telegram_id']
+        fields = ['telegram_id', 'blocked', 'tags', 'attributes']
+        read_only_fields = ['blocked']
+
+    def validate_attributes(self, value):
+        return validate_attributes(value)
+
+    def create(self, validated_data):
+        tags = validated_data.pop('tags', [])
+        with transaction.atomic():
+            user = super().create(validated_data)
+            user.tags.set(self.get_tags(tags))
+            refresh_segments(User.objects.filter(id=user.id))
+        return user
+
+    def update(self, instance, validated_data):
+        tags = validated_data.pop('tags', None)
+        with transaction.atomic():
+            user = super().update(instance, validated_data)
+            if tags is not None:
+                user.tags.set(self.get_tags(tags))
+            refresh_segments(User.objects.filter(id=user.id))
+        return user
+
+    def get_tags(self, names):
+        Tag.objects.bulk_create([Tag(name=name) for name in set(names)], ignore_conflicts=True)
+        return Tag.objects.filter(name__in=names)
+
+
+class SegmentFilterSerializer(serializers.Serializer):
+    tags = serializers.ListField(child=serializers.SlugField(max_length=64), required=False, default=list)
+    attributes = serializers.DictField(required=False, default=dict, validators=[validate_attributes])
+
+
+class SegmentSerializer(serializers.ModelSerializer):
+    tags = serializers.ListField(child=serializers.SlugField(max_length=64), required=False)
+
+    class Meta:
+        model = Segment
+        fields = ['id', 'name', 'tags', 'attributes', 'version', 'size', 'refreshed_at']
+        read_only_fields = ['version', 'size', 'refreshed_at']
+
+    def validate_attributes(self, value):
+        return validate_attributes(value)
+
+    def create(self, validated_data):
+        return build_segment(super().create(validated_data))
+
+    def update(self, instance, validated_data):
+        key = instance.key
+        segment = super().update(instance, validated_data)
+        if segment.key != key:
+            build_segment(segment)
+        return segment
+
+
+class MediaSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Media
+        fields = ['id', 'sha256', 'type', 'filename', 'content_type', 'size', 'file_id', 'created_at']
+        read_only_fields = fields
 
 
 class BroadcastSerializer(serializers.ModelSerializer):
+    # Accepted on create only; the audience is stored as a packed RecipientList and never sent back
+    users = serializers.ListField(child=TelegramIdField(), write_only=True, required=False)
+    # Accepted on create only: an ad hoc segment, sent to the cached segment with the same filter
+    segment_filter = SegmentFilterSerializer(write_only=True, required=False)
+
+    class Meta:
+        model = Broadcast
+        fields = ['id', 'message', 'type', 'buttons', 'file_id', 'media', 'created_at', 'status', 'priority',
+                  'scheduled_at', 'recurrence', 'delivery_window', 'total_target_users', 'total_successful',
+                  'total_failed', 'targeted', 'users', 'segment', 'segment_filter', 'segment_version']
+        read_only_fields = ['targeted', 'segment_version']
+
+    def validate(self, attrs):
+        audiences = [name for name in ('users', 'segment', 'segment_filter') if attrs.get(name)]
+        if len(audiences) > 1:
+            raise serializers.ValidationError(f"Give only one of {', '.join(audiences)}")
+        if self.instance is not None and 'segment' in attrs and self.instance.status != 'draft':
+            raise serializers.ValidationError({'segment': "The audience can only be changed on a draft broadcast"})
+        media = attrs.get('media')
+        if media is not None:
+            if attrs.get('file_id'):
+                raise serializers.ValidationError("Give only one of file_id, media")
+            # The type follows the media unless it is given
+            attrs.setdefault('type', media.type if self.instance is None else self.instance.type)
+            if attrs['type'] != media.type:
+                raise serializers.ValidationError({'media': f"The media has type {media.type}, not {attrs['type']}"})
+        recurrence = attrs.get('recurrence', self.instance.recurrence if self.instance else '')
+        scheduled_at = attrs.get('scheduled_at', self.instance.scheduled_at if self.instance else None)
+        if recurrence and scheduled_at is None:
+            raise serializers.ValidationError({'scheduled_at': "A recurring broadcast needs a first scheduled time"})
+        return attrs
+
+    def validate_delivery_window(self, value):
+        if value is not None and value.total_seconds() <= 0:
+            raise serializers.ValidationError("The delivery window must be positive")
+        return value
+
+    def create(self, validated_data):
+        users = validated_data.pop('users', None)
+        segment_filter = validated_data.pop('segment_filter', None)
+        with transaction.atomic():
+            if segment_filter:
+                validated_data['segment'] = get_segment(segment_filter['tags'], segment_filter['attributes'])
+            broadcast = super().create(validated_data)
+            if users:
+                broadcast.add_recipients(users)
+        return broadcast
+
+    def update(self, instance, validated_data):
+        validated_data.pop('users', None)
+        validated_data.pop('segment_filter', None)
+        return super().update(instance, validated_data)
+
+
+class BroadcastProgressSerializer(serializers.ModelSerializer):
     class Meta:
         model = Broadcast
-        fields = ['id', 'message', 'type', 'buttons', 'file_id', 'created_at', 'status', 'total_target_users',
-                  'total_successful', 'total_failed', 'users']
+        fields = ['id', 'status', 'total_target_users', 'total_successful', 'total_failed', 'updated_at']
@@ -0,0 +1,14 @@
+from django.db.models import F
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from broadcast.models import Broadcast, Counter
+
+DELETIONS_KEY = 'broadcast-deletions'  # Part of the progress ETag, since a deleted row leaves no updated_at behind
+
+
+@receiver(post_delete, sender=Broadcast)
+def count_deletion(sender, instance, **kwargs):
+    # In the deleting transaction, so the count cannot run ahead of or behind the rows
+    Counter.objects.bulk_create([Counter(name=DELETIONS_KEY)], ignore_conflicts=True)
+    Counter.objects.filter(name=DELETIONS_KEY).update(value=F('value') + 1)
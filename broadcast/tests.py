@@ -1,3 +1,321 @@
-from django.test import TestCase
+import sys
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import Client, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from broadcast.audience import INT64_MAX, INT64_MIN, RecipientSet
+from broadcast.ingest import import_users, parse_csv, parse_json, parse_ndjson, parse_telegram_id
+from broadcast.models import Broadcast, Counter, Media, Segment, Tag, User
+from broadcast import segments
+from broadcast.segments import build_segment, matching_users
+from broadcast.signals import DELETIONS_KEY
+
+
+class RecipientSetTests(SimpleTestCase):
+    def test_from_ids_sorts_and_drops_duplicates(self):
+        recipients = RecipientSet.from_ids([5, 3, 5, INT64_MAX, -1, 3, INT64_MIN])
+        self.assertEqual(list(recipients), [INT64_MIN, -1, 3, 5, INT64_MAX])
+        self.assertEqual(len(recipients), 5)
+
+    def test_from_sorted_drops_repeats(self):
+        self.assertEqual(list(RecipientSet.from_sorted([1, 1, 2, 3, 3, 3])), [1, 2, 3])
+
+    def test_bytes_round_trip(self):
+        recipients = RecipientSet.from_ids([7, 1, 4])
+        data = recipients.to_bytes()
+        self.assertEqual(len(data), 3 * RecipientSet.ITEM_SIZE)
+        self.assertEqual(RecipientSet.from_bytes(data), recipients)
+
+    def test_bytes_are_little_endian(self):
+        recipients = RecipientSet.from_ids([-2, 258])
+        data = (-2).to_bytes(8, "little", signed=True) + (258).to_bytes(8, "little", signed=True)
+        self.assertEqual(recipients.to_bytes(), data)
+        self.assertEqual(RecipientSet.from_bytes(data), recipients)
+        # The swap a machine of the other byte order makes on the way in and out undoes itself
+        with mock.patch.object(sys, "byteorder", "big" if sys.byteorder == "little" else "little"):
+            swapped = recipients.to_bytes()
+            self.assertEqual(RecipientSet.from_bytes(swapped), recipients)
+        self.assertEqual(swapped, (-2).to_bytes(8, "big", signed=True) + (258).to_bytes(8, "big", signed=True))
+
+    def test_contains(self):
+        recipients = RecipientSet.from_ids([2, 4, 6])
+        self.assertIn(4, recipients)
+        self.assertNotIn(5, recipients)
+        self.assertNotIn(7, recipients)
+        self.assertNotIn(1, RecipientSet())
+
+    def test_union(self):
+        union = RecipientSet.from_ids([1, 3, 5]).union(RecipientSet.from_ids([2, 3]), RecipientSet.from_ids([5, 9]))
+        self.assertEqual(list(union), [1, 2, 3, 5, 9])
+        self.assertEqual(list(RecipientSet().union()), [])
+
+    def test_difference(self):
+        recipients = RecipientSet.from_ids([1, 2, 3, 4, 5])
+        self.assertEqual(list(recipients.difference(RecipientSet.from_ids([0, 2, 4]))), [1, 3, 5])
+        # The excluded ids run out before the set does
+        self.assertEqual(list(recipients.difference(RecipientSet.from_ids([1]))), [2, 3, 4, 5])
+        self.assertEqual(list(recipients.difference(RecipientSet())), [1, 2, 3, 4, 5])
+        self.assertEqual(list(RecipientSet().difference(recipients)), [])
+
+    def test_intersection(self):
+        recipients = RecipientSet.from_ids([1, 2, 3, 4])
+        self.assertEqual(list(recipients.intersection(RecipientSet.from_ids([0, 2, 4, 8]))), [2, 4])
+        self.assertEqual(list(recipients.intersection(RecipientSet())), [])
+
+
+class IngestParserTests(SimpleTestCase):
+    def test_parse_telegram_id(self):
+        self.assertEqual(parse_telegram_id(42), 42)
+        self.assertEqual(parse_telegram_id(" -42 "), -42)
+        self.assertEqual(parse_telegram_id(str(INT64_MAX)), INT64_MAX)
+        for value in (12.9, 12.0, True, "1e3", "", None, INT64_MAX + 1, str(INT64_MIN - 1)):
+            with self.assertRaises(ValueError, msg=repr(value)):
+                parse_telegram_id(value)
+
+    def test_parse_json(self):
+        rows = parse_json([1, "2", {"telegram_id": 3, "blocked": True}, {"telegram_id": "4", "blocked": "false"},
+                           12.9, 2 ** 63, {"blocked": True}, {"telegram_id": 5, "blocked": "maybe"}])
+        self.assertEqual(list(rows), [(1, None, None, None), (2, None, None, None), (3, True, None, None),
+                                      (4, False, None, None), None, None, None, None])
+        self.assertEqual(list(parse_json({"telegram_id": 1})), [])
+
+    def test_parse_tags_and_attributes(self):
+        rows = parse_json([{"telegram_id": 1, "tags": ["vip", "en", "vip"], "attributes": {"plan": "pro"}},
+                           {"telegram_id": 2, "tags": []}, {"telegram_id": 3, "tags": "vip"},
+                           {"telegram_id": 4, "tags": ["no spaces"]}, {"telegram_id": 5, "attributes": {"a__b": 1}},
+                           {"telegram_id": 6, "attributes": {"plan": ["pro"]}}])
+        self.assertEqual(list(rows), [(1, None, ["en", "vip"], {"plan": "pro"}), (2, None, [], None),
+                                      None, None, None, None])
+
+    def test_parse_ndjson(self):
+        lines = [b'{"telegram_id": 1}\n', b"\n", b'{"telegram_id": 2, "blocked": false}\n', b"not json\n",
+                 b'{"telegram_id": 99999999999999999999}\n', b'{"telegram_id": true}\n']
+        self.assertEqual(list(parse_ndjson(lines)), [(1, None, None, None), (2, False, None, None), None, None, None])
+
+    def test_parse_csv(self):
+        lines = [b"telegram_id,blocked,tags,attributes\n", b"1,1\n", b"2\n", b"3,\n", b"12.9,0\n",
+                 b"9223372036854775808\n", b"4,yes\n", b'5,,vip en,"{""plan"": ""pro""}"\n', b"6,,,[1]\n"]
+        self.assertEqual(list(parse_csv(lines)), [(1, True, None, None), (2, None, None, None), (3, None, None, None),
+                                                  None, None, None, (5, None, ["en", "vip"], {"plan": "pro"}), None])
+
+
+class ImportUsersTests(TestCase):
+    def test_counts(self):
+        User.objects.create(telegram_id=1)
+        User.objects.create(telegram_id=2, blocked=True)
+        counts = import_users([(1, None, None, None), (2, False, None, None), (3, True, None, None),
+                               (3, True, None, None), None])
+        self.assertEqual(counts, {"inserted": 1, "updated": 1, "skipped": 2, "invalid": 1})
+        self.assertEqual(dict(User.objects.values_list("telegram_id", "blocked")), {1: False, 2: False, 3: True})
+
+    def test_tags_and_attributes(self):
+        User.objects.create(telegram_id=1, attributes={"plan": "free"})
+        counts = import_users([(1, None, ["vip"], {"plan": "pro"}), (2, None, ["vip", "en"], {"plan": "free"}),
+                               (3, None, None, None)])
+        self.assertEqual(counts, {"inserted": 2, "updated": 1, "skipped": 0, "invalid": 0})
+        # The same values again change nothing, and None leaves a field as it is
+        counts = import_users([(1, None, ["vip"], {"plan": "pro"}), (2, None, None, None), (3, None, [], {})])
+        self.assertEqual(counts, {"inserted": 0, "updated": 0, "skipped": 3, "invalid": 0})
+        self.assertEqual(import_users([(2, None, ["en"], None)])["updated"], 1)
+        users = {user.telegram_id: user for user in User.objects.prefetch_related("tags")}
+        self.assertEqual({telegram_id: sorted(tag.name for tag in user.tags.all()) for telegram_id, user in users.items()},
+                         {1: ["vip"], 2: ["en"], 3: []})
+        self.assertEqual(users[1].attributes, {"plan": "pro"})
+        self.assertEqual(users[2].attributes, {"plan": "free"})
+
+    def test_bulk_create_rejects_the_whole_list(self):
+        response = APIClient().post("/api/users/bulk_create/", [1, 2.5], format="json")
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(User.objects.exists())
+
+
+class SegmentTests(TestCase):
+    """Every way users change keeps a built segment's members and size what ``matching_users`` says."""
+
+    def setUp(self):
+        import_users([(1, None, ["vip"], {"plan": "pro"}), (2, None, ["vip"], {"plan": "free"}),
+                      (3, None, [], {"plan": "pro"})])
+        self.segment = build_segment(Segment.objects.create(tags=["vip"], attributes={"plan": "pro"}))
+        self.everyone = build_segment(Segment.objects.create())
+
+    def assertSegmentsMatch(self):
+        for segment in (self.segment, self.everyone):
+            segment.refresh_from_db()
+            members = sorted(segment.members.values_list("user__telegram_id", flat=True))
+            self.assertEqual(members, sorted(matching_users(segment).values_list("telegram_id", flat=True)))
+            self.assertEqual(segment.size, len(members))
+
+    def test_build(self):
+        self.assertEqual(list(self.segment.members.values_list("user__telegram_id", flat=True)), [1])
+        self.assertSegmentsMatch()
+
+    def test_rebuild_in_chunks(self):
+        import_users([(telegram_id, None, ["vip"], {"plan": "pro"}) for telegram_id in range(4, 10)])
+        Segment.objects.filter(id=self.segment.id).update(attributes={"plan": "free"}, size=99)
+        self.segment.refresh_from_db()
+        with mock.patch.object(segments, "CHUNK_SIZE", 2):
+            build_segment(self.segment)
+        self.assertFalse(self.segment.building)
+        self.assertSegmentsMatch()
+        self.assertEqual(self.segment.size, 1)
+
+    def test_import(self):
+        import_users([(2, None, None, {"plan": "pro"}), (3, None, ["vip"], None), (1, True, None, None),
+                      (4, None, ["vip"], {"plan": "pro"})])
+        self.assertSegmentsMatch()
+        self.assertEqual(self.segment.size, 3)
+
+    def test_users_api(self):
+        client = APIClient()
+        ids = dict(User.objects.values_list("telegram_id", "id"))
+        response = client.patch(f"/api/users/{ids[3]}/", {"tags": ["vip"]}, format="json")
+        self.assertEqual(response.status_code, 200)
+        response = client.post("/api/users/", {"telegram_id": 4, "tags": ["vip"], "attributes": {"plan": "pro"}},
+                               format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(client.delete(f"/api/users/{ids[1]}/").status_code, 204)
+        self.assertSegmentsMatch()
+        self.assertEqual(self.segment.size, 2)
+
+    def test_admin(self):
+        admin = Client()
+        admin.force_login(get_user_model().objects.create_superuser("admin", "admin@example.com", "x"))
+        user = User.objects.get(telegram_id=3)
+        response = admin.post(f"/admin/broadcast/user/{user.id}/change/", {
+            "telegram_id": 3, "tags": [Tag.objects.get(name="vip").id], "attributes": '{"plan": "pro"}',
+        })
+        self.assertEqual(response.status_code, 302)
+        self.assertSegmentsMatch()
+        self.assertEqual(self.segment.size, 2)
+
+        self.assertEqual(admin.post(f"/admin/broadcast/user/{user.id}/delete/", {"post": "yes"}).status_code, 302)
+        self.assertSegmentsMatch()
+        self.assertEqual(self.segment.size, 1)
+        admin.post("/admin/broadcast/user/", {
+            "action": "delete_selected", "post": "yes", "_selected_action": list(User.objects.values_list("id", flat=True)),
+        })
+        self.assertFalse(User.objects.exists())
+        self.assertSegmentsMatch()
+        self.assertEqual(self.everyone.size, 0)
+
+
+class BroadcastRecipientsTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+
+    def test_recipients_are_added_to_a_draft(self):
+        broadcast = Broadcast.objects.create(message="Hi", status="draft")
+        response = self.client.post(f"/api/broadcasts/{broadcast.id}/recipients/", [3, "1", 3, 2], format="json")
+        self.assertEqual(response.json(), {"received": 4, "duplicates": 1, "total": 3})
+        self.assertEqual(list(broadcast.merged_recipients()), [1, 2, 3])
+
+    def test_ids_must_be_integers(self):
+        broadcast = Broadcast.objects.create(message="Hi", status="draft")
+        for users in ([1.9], [True], ["1e3"], [INT64_MAX + 1], [None]):
+            response = self.client.post(f"/api/broadcasts/{broadcast.id}/recipients/", users, format="json")
+            self.assertEqual(response.status_code, 400, users)
+        self.assertFalse(broadcast.recipient_lists.exists())
+
+    def test_create_takes_the_same_ids(self):
+        response = self.client.post("/api/broadcasts/", {"message": "Hi", "users": [1.9, True]}, format="json")
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post("/api/broadcasts/", {"message": "Hi", "users": ["5", 5, 7]}, format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(list(Broadcast.objects.get(id=response.json()["id"]).merged_recipients()), [5, 7])
+
+
+class ProgressTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+
+    def poll(self, etag=None, path="/api/broadcasts/progress/"):
+        return self.client.get(path, **({"HTTP_IF_NONE_MATCH": etag} if etag else {}))
+
+    def test_unchanged_progress_is_not_modified(self):
+        Broadcast.objects.create(message="Hi")
+        first = self.poll()
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual([row["status"] for row in first.json()["results"]], ["pending"])
+        with self.assertNumQueries(1):
+            again = self.poll(first["ETag"])
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(again["ETag"], first["ETag"])
+        # Each query string has its own ETag
+        self.assertEqual(self.poll(first["ETag"], "/api/broadcasts/progress/?status=pending").status_code, 200)
+
+    def test_started_broadcast_changes_the_etag(self):
+        broadcast = Broadcast.objects.create(message="Hi", status="draft")
+        etag = self.poll()["ETag"]
+        self.assertEqual(self.client.post(f"/api/broadcasts/{broadcast.id}/start/").status_code, 200)
+        response = self.poll(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["results"][0]["status"], "pending")
+
+    def test_worker_progress_changes_the_etag(self):
+        broadcast = Broadcast.objects.create(message="Hi")
+        etag = self.poll()["ETag"]
+        broadcast.add_recipients([1, 2])
+        etag, previous = self.poll(etag)["ETag"], etag
+        self.assertNotEqual(etag, previous)
+        Broadcast.objects.filter(id=broadcast.id).update(status="inprogress", updated_at=timezone.now())
+        self.assertEqual(self.poll(etag).status_code, 200)
+
+
+    def test_deletion_changes_the_etag(self):
+        older = Broadcast.objects.create(message="Hi")
+        Broadcast.objects.create(message="Later")
+        etag = self.poll()["ETag"]
+        # Not the latest updated_at, so only the deletion count tells
+        self.assertEqual(self.client.delete(f"/api/broadcasts/{older.id}/").status_code, 204)
+        self.assertEqual(Counter.objects.get(name=DELETIONS_KEY).value, 1)
+        response = self.poll(etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()["results"]), 1)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.poll(response["ETag"]).status_code, 304)
+
+
+class MediaUploadTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        media_settings = override_settings(MEDIA_ROOT=media_root.name)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        self.client = APIClient()
+
+    def upload(self, content, name="photo.jpg", content_type="image/jpeg", **data):
+        file = SimpleUploadedFile(name, content, content_type=content_type)
+        return self.client.post("/api/media/", {"file": file, **data}, format="multipart")
+
+    def test_same_content_is_stored_once(self):
+        first = self.upload(b"image bytes")
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(first.json()["type"], "image")
+        again = self.upload(b"image bytes", name="copy.jpg")
+        self.assertEqual(again.status_code, 200)
+        self.assertEqual(again.json()["id"], first.json()["id"])
+        self.assertEqual(Media.objects.count(), 1)
+
+    def test_rejects_other_files(self):
+        self.assertEqual(self.upload(b"text", name="notes.txt", content_type="text/plain").status_code, 400)
+        self.upload(b"image bytes")
+        self.assertEqual(self.upload(b"image bytes", type="video").status_code, 400)
+
+    def test_broadcast_takes_the_media_type(self):
+        media_id = self.upload(b"video bytes", name="clip.mp4", content_type="video/mp4").json()["id"]
+        response = self.client.post("/api/broadcasts/", {"message": "Watch", "media": media_id}, format="json")
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()["type"], "video")
+        response = self.client.post("/api/broadcasts/", {"message": "Look", "media": media_id, "type": "image"},
+                                    format="json")
+        self.assertEqual(response.status_code, 400)
+        # Media a broadcast is sent with cannot be deleted
+        self.assertEqual(self.client.delete(f"/api/media/{media_id}/").status_code, 400)
+        Broadcast.objects.all().delete()
+        self.assertEqual(self.client.delete(f"/api/media/{media_id}/").status_code, 204)
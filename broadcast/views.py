@@ -1,26 +1,140 @@
+import hashlib
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, ProtectedError, Q, Subquery, Sum
 from django.shortcuts import render
+from django.utils.dateparse import parse_datetime
+from django.utils.http import parse_etags, quote_etag
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework import status
 from rest_framework.decorators import action
 from rest_framework.filters import SearchFilter, OrderingFilter
+from rest_framework.parsers import FormParser, MultiPartParser
 from rest_framework.response import Response
 from rest_framework.viewsets import ModelViewSet
 
-from broadcast.models import User, Broadcast
-from broadcast.serialisers import BroadcastSerializer, UserSerializer
+from broadcast.ingest import import_users, parse_csv, parse_json, parse_ndjson, parse_telegram_id
+from broadcast.models import Counter, Media, Segment, User, Broadcast
+from broadcast.pagination import ProgressPagination
+from broadcast.segments import build_segment, refresh_segments
+from broadcast.serialisers import (BroadcastProgressSerializer, BroadcastSerializer, MediaSerializer, SegmentSerializer,
+                                   UserSerializer)
+from broadcast.signals import DELETIONS_KEY
 
 
 class UserViewSet(ModelViewSet):
-    queryset = User.objects.all()
+    queryset = User.objects.prefetch_related('tags')
     serializer_class = UserSerializer
 
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            refresh_segments(User.objects.filter(id=instance.id), removed=True)
+            instance.delete()
+
     @action(detail=False, methods=['post'])
     def bulk_create(self, request):
-        serializer = UserSerializer(data=request.data, many=True)
-        if serializer.is_valid():
-            serializer.save()
-            return Response({"message": "Users created successfully"}, status=status.HTTP_201_CREATED)
-        return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        rows = list(parse_json(request.data))
+        if not isinstance(request.data, list) or None in rows:
+            return Response({"error": "Expected a list of users with integer telegram ids, tag lists and "
+                                      "attribute objects"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        counts = import_users(rows)
+        return Response({"message": "Users created successfully", **counts}, status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['post'])
+    def bulk_import(self, request):
+        """Upsert users streamed as NDJSON or CSV (``telegram_id,blocked,tags,attributes``) without buffering the body."""
+        content_type = request.content_type.split(';')[0].strip()
+        if content_type in ('application/x-ndjson', 'application/jsonl'):
+            rows = parse_ndjson(request.stream or [])
+        elif content_type == 'text/csv':
+            rows = parse_csv(request.stream or [])
+        else:
+            return Response({"error": "Send application/x-ndjson or text/csv"},
+                            status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        return Response(import_users(rows))
+
+    @action(detail=False, methods=['get'])
+    def stats(self, request):
+        """Report how many users the worker has pruned after Telegram said they blocked the bot."""
+        counts = User.objects.aggregate(total=Count('id'), blocked=Count('id', filter=Q(blocked=True)))
+        counts['active'] = counts['total'] - counts['blocked']
+        return Response(counts)
+
+
+class SegmentViewSet(ModelViewSet):
+    queryset = Segment.objects.all()
+    serializer_class = SegmentSerializer
+
+    def destroy(self, request, *args, **kwargs):
+        try:
+            return super().destroy(request, *args, **kwargs)
+        except ProtectedError:
+            return Response({"error": "The segment is the audience of existing broadcasts"},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+    @action(detail=True, methods=['post'])
+    def refresh(self, request, pk=None):
+        """Rebuild the segment's members from scratch, e.g. after users were changed outside the API."""
+        segment = build_segment(self.get_object())
+        return Response(self.get_serializer(segment).data)
+
+
+class MediaViewSet(ModelViewSet):
+    queryset = Media.objects.order_by('id')
+    serializer_class = MediaSerializer
+    parser_classes = [MultiPartParser, FormParser]
+    http_method_names = ['get', 'post', 'delete', 'head', 'options']
+
+    def create(self, request, *args, **kwargs):
+        """Store an image or video once per content, for broadcasts to refer to by its id.
+
+        Send it as the ``file`` field of a multipart form; ``type`` is taken from its content
+        type unless given. The same content uploaded again returns the stored media, with
+        the file_id of its first upload to Telegram once a broadcast has sent it.
+        """
+        upload = request.FILES.get('file')
+        if upload is None:
+            return Response({"error": "Send the media as the file field of a multipart form"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        media_type = request.data.get('type') or (upload.content_type or '').split('/')[0]
+        if media_type not in Media.MAX_SIZES:
+            return Response({"error": "Expected an image or a video"}, status=status.HTTP_400_BAD_REQUEST)
+        if upload.size > Media.MAX_SIZES[media_type]:
+            return Response({"error": f"A {media_type} can be at most {Media.MAX_SIZES[media_type] // 2 ** 20} MB"},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        digest = hashlib.sha256()
+        for chunk in upload.chunks():
+            digest.update(chunk)
+        media = Media.objects.filter(sha256=digest.hexdigest()).first()
+        created = media is None
+        if created:
+            media = Media(sha256=digest.hexdigest(), type=media_type, filename=upload.name[-255:],
+                          content_type=upload.content_type or '', size=upload.size)
+            media.file.save(upload.name, upload, save=False)
+            try:
+                with transaction.atomic():
+                    media.save()
+            except IntegrityError:
+                # The same content was stored by a concurrent upload
+                media.file.delete(save=False)
+                media, created = Media.objects.get(sha256=digest.hexdigest()), False
+        if media.type != media_type:
+            return Response({"error": f"The file was uploaded before as type {media.type}"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response(self.get_serializer(media).data,
+                        status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
+
+    def perform_destroy(self, instance):
+        instance.delete()
+        instance.file.delete(save=False)
+
+    def destroy(self, request, *args, **kwargs):
+        try:
+            return super().destroy(request, *args, **kwargs)
+        except ProtectedError:
+            return Response({"error": "The media is sent by existing broadcasts"}, status=status.HTTP_400_BAD_REQUEST)
 
 
 class BroadcastViewSet(ModelViewSet):
@@ -36,9 +150,81 @@ class BroadcastViewSet(ModelViewSet):
     search_fields = ['message']
 
     # Specify fields for ordering
-    ordering_fields = ['created_at', 'total_target_users', 'total_successful', 'total_failed']
+    ordering_fields = ['created_at', 'scheduled_at', 'total_target_users', 'total_successful', 'total_failed']
     ordering = ['created_at']  # Default ordering
 
+    MAX_RECIPIENTS_PER_REQUEST = 100000
+
+    @action(detail=False, methods=['get'], pagination_class=ProgressPagination, filter_backends=[])
+    def progress(self, request):
+        """Status and counters only, for dashboards that poll.
+
+        ``since`` limits the page to broadcasts changed after that time, and a matching
+        ``If-None-Match`` gets a 304 after a single indexed lookup of the latest ``updated_at``.
+        """
+        queryset = Broadcast.objects.all()
+        if request.query_params.get('status'):
+            queryset = queryset.filter(status=request.query_params['status'])
+        if request.query_params.get('since'):
+            since = parse_datetime(request.query_params['since'])
+            if since is None:
+                return Response({"error": "since must be an ISO 8601 datetime"}, status=status.HTTP_400_BAD_REQUEST)
+            queryset = queryset.filter(updated_at__gt=since)
+
+        # Any broadcast written, created or deleted since changes the ETag. The latest updated_at is taken over
+        # the whole table rather than the filtered rows, so a broadcast leaving the filter counts too and it is
+        # one lookup in its index; the deletion count is read by the same query
+        deletions = Counter.objects.filter(name=DELETIONS_KEY).values('value')
+        changed, deleted = (
+            Broadcast.objects.order_by('-updated_at').values_list('updated_at', Subquery(deletions)).first()
+            or (None, None)  # No broadcasts left: the page is empty whatever was deleted before
+        )
+        state = f"{changed}:{deleted or 0}:{request.get_full_path()}"
+        etag = quote_etag(hashlib.md5(state.encode()).hexdigest())
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+        page = self.paginate_queryset(queryset.only(*BroadcastProgressSerializer.Meta.fields))
+        response = self.get_paginated_response(BroadcastProgressSerializer(page, many=True).data)
+        response['ETag'] = etag
+        return response
+
+    @action(detail=True, methods=['post'])
+    def recipients(self, request, pk=None):
+        """Append a chunk of telegram ids to the explicit audience of a draft broadcast.
+
+        ``total`` counts the ids of every chunk so far; ids repeated across chunks are only
+        dropped when the broadcast is planned.
+        """
+        broadcast = self.get_object()
+        if broadcast.status != 'draft':
+            return Response({"error": "Recipients can only be added to a draft broadcast"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        if broadcast.segment_id:
+            return Response({"error": "The broadcast is sent to a segment"}, status=status.HTTP_400_BAD_REQUEST)
+        users = request.data.get('users') if isinstance(request.data, dict) else request.data
+        if not isinstance(users, list) or len(users) > self.MAX_RECIPIENTS_PER_REQUEST:
+            return Response({"error": f"Expected a list of at most {self.MAX_RECIPIENTS_PER_REQUEST} telegram ids"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        try:
+            telegram_ids = [parse_telegram_id(telegram_id) for telegram_id in users]
+        except ValueError:
+            return Response({"error": "Telegram ids must be integers that fit in 64 bits"},
+                            status=status.HTTP_400_BAD_REQUEST)
+        unique = broadcast.add_recipients(telegram_ids)
+        total = broadcast.recipient_lists.aggregate(total=Sum('size'))['total']
+        return Response({"received": len(telegram_ids), "duplicates": len(telegram_ids) - unique, "total": total})
+
+    @action(detail=True, methods=['post'])
+    def start(self, request, pk=None):
+        """Hand a draft broadcast over to the workers."""
+        broadcast = self.get_object()
+        if broadcast.status != 'draft':
+            return Response({"error": "Only a draft broadcast can be started"}, status=status.HTTP_400_BAD_REQUEST)
+        broadcast.status = 'pending'
+        broadcast.save(update_fields=['status', 'updated_at'])
+        return Response(self.get_serializer(broadcast).data)
+
 
 def index(request):
     return render(request, 'index.html')
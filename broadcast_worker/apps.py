@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class BroadcastWorkerConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'broadcast_worker'
+
+    def ready(self):
+        from broadcast_worker import signals  # noqa: F401
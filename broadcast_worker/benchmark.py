@@ -0,0 +1,172 @@
+import hashlib
+import json
+import random
+import resource
+import threading
+import time
+from email import policy
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import aiohttp
+from django.db.backends.signals import connection_created
+
+
+class FakeBotAPI(ThreadingHTTPServer):
+    """Local stand-in for the Bot API that answers every send after ``latency`` seconds.
+
+    A share ``p429`` of requests is rate limited with ``retry_after``, and a share ``p403``
+    of chats has blocked the bot (always the same chats, as with real users). Photos and
+    videos are answered with a file_id: the one sent, or for a file uploaded as multipart
+    form data, one derived from its content. ``uploads`` counts the files received.
+    """
+
+    daemon_threads = True
+    request_queue_size = 1024  # The async worker opens up to MAX_CONCURRENCY connections at once
+
+    def __init__(self, port=0, latency=0.05, p429=0.0, p403=0.0, retry_after=1):
+        super().__init__(("127.0.0.1", port), FakeBotAPIHandler)
+        self.latency = latency
+        self.p429 = p429
+        self.p403 = p403
+        self.retry_after = retry_after
+        self.lock = threading.Lock()
+        self.responses = {}  # Status code -> count
+        self.uploads = 0
+        self.first_request_at = None
+        self.last_request_at = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def respond(self, chat_id, method="sendMessage", file_id=None):
+        """Return the status code and body for a send to ``chat_id``, and count it."""
+        time.sleep(self.latency)
+        if random.random() < self.p429:
+            status, body = 429, {"ok": False, "error_code": 429,
+                                 "description": f"Too Many Requests: retry after {self.retry_after}",
+                                 "parameters": {"retry_after": self.retry_after}}
+        elif random.Random(chat_id).random() < self.p403:
+            status, body = 403, {"ok": False, "error_code": 403, "description": "Forbidden: bot was blocked by the user"}
+        else:
+            status, body = 200, {"ok": True, "result": {"message_id": 1, "chat": {"id": chat_id}}}
+            if method == "sendPhoto":
+                body["result"]["photo"] = [{"file_id": f"{file_id}-thumb"}, {"file_id": file_id}]
+            elif method == "sendVideo":
+                body["result"]["video"] = {"file_id": file_id}
+        now = time.monotonic()
+        with self.lock:
+            self.responses[status] = self.responses.get(status, 0) + 1
+            self.first_request_at = self.first_request_at or now
+            self.last_request_at = now
+        return status, body
+
+
+class FakeBotAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep-alive, like api.telegram.org
+
+    def do_POST(self):
+        request = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        method = self.path.rsplit("/", 1)[-1]
+        if self.headers.get_content_type() == "multipart/form-data":
+            fields = self.parse_form(request)
+        else:
+            try:
+                fields = json.loads(request)
+            except ValueError:
+                fields = {}
+        file = fields.get({"sendPhoto": "photo", "sendVideo": "video"}.get(method))
+        if isinstance(file, bytes):
+            with self.server.lock:
+                self.server.uploads += 1
+            file = f"fake-{hashlib.sha256(file).hexdigest()[:32]}"
+        try:
+            chat_id = int(fields["chat_id"])
+        except (ValueError, KeyError, TypeError):
+            chat_id = 0
+        status, body = self.server.respond(chat_id, method, file)
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def parse_form(self, request):
+        """Return the fields of a multipart form, files as bytes."""
+        header = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode()
+        form = BytesParser(policy=policy.HTTP).parsebytes(header + request)
+        return {
+            part.get_param("name", header="content-disposition"): (
+                part.get_payload(decode=True) if part.get_filename() else part.get_content()
+            )
+            for part in form.iter_parts()
+        }
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SenderStats:
+    """Send latencies and database statements of a worker process, for ``send_benchmark``.
+
+    ``instrument`` hooks a sender command instance: requests' ``Response.elapsed`` for the
+    threaded sender, aiohttp tracing for the async one. Every database connection the
+    process opens, in any thread, has its statements counted.
+    """
+
+    WRITES = ("INSERT", "UPDATE", "DELETE")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.queries = 0
+        self.writes = 0
+        connection_created.connect(self.watch_connection, weak=False)
+
+    def watch_connection(self, sender, connection, **kwargs):
+        connection.execute_wrappers.append(self.count_query)
+
+    def count_query(self, execute, sql, params, many, context):
+        with self.lock:
+            self.queries += 1
+            self.writes += sql.lstrip().upper().startswith(self.WRITES)
+        return execute(sql, params, many, context)
+
+    def instrument(self, command):
+        if hasattr(command, "init_worker"):
+            init_worker = command.init_worker
+
+            def init_timed_worker():
+                init_worker()
+                command.local.session.hooks["response"].append(
+                    lambda response, *args, **kwargs: self.latencies.append(response.elapsed.total_seconds())
+                )
+
+            command.init_worker = init_timed_worker
+        else:
+            async def on_request_start(session, context, params):
+                context.started = time.perf_counter()
+
+            async def on_request_end(session, context, params):
+                self.latencies.append(time.perf_counter() - context.started)
+
+            trace_config = aiohttp.TraceConfig()
+            trace_config.on_request_start.append(on_request_start)
+            trace_config.on_request_end.append(on_request_end)
+            command.TRACE_CONFIGS = [trace_config]
+
+    def summary(self):
+        latencies = sorted(self.latencies) or [0]
+        return {
+            "requests": len(self.latencies),
+            "latency_p50": latencies[len(latencies) // 2],
+            "latency_p99": latencies[len(latencies) * 99 // 100],
+            "queries": self.queries,
+            "writes": self.writes,
+            "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
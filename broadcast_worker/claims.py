@@ -0,0 +1,259 @@
+import math
+import os
+import socket
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Max, Min, Q
+from django.utils import timezone
+
+from broadcast.audience import RecipientSet
+from broadcast.models import Broadcast, Media, SegmentMember, User
+from broadcast.segments import ensure_built, release_segment
+from broadcast_worker.events import publish
+from broadcast_worker.models import BroadcastShard
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+LEASE = timedelta(seconds=settings.BROADCAST_LEASE_SECONDS)
+
+
+def claim_shard(exclude=()):
+    """Claim the next free shard for this worker process, planning the next new broadcast first.
+
+    Shards of higher-priority broadcasts are claimed first, then the oldest. Broadcasts in
+    ``exclude`` (those the worker already sends) are skipped. Claims are compare-and-set
+    updates on ``BroadcastShard``, so any number of worker processes can share the table
+    without row locks and no shard is held by two of them. A shard whose lease ran out
+    (its worker died) becomes claimable again.
+    """
+    # Plan before claiming, so a new broadcast is not queued behind the free shards of a big one
+    plan_next_broadcast()
+    return claim_free_shard(exclude)
+
+
+def claimable(now):
+    return (
+        Q(status="pending") & (Q(not_before__isnull=True) | Q(not_before__lte=now))
+        | Q(status="inprogress", lease_expires_at__lt=now)
+    )
+
+
+def due(now):
+    return Q(scheduled_at__isnull=True) | Q(scheduled_at__lte=now)
+
+
+def claim_free_shard(exclude=()):
+    now = timezone.now()
+    candidates = (
+        BroadcastShard.objects
+        .filter(claimable(now))
+        .exclude(broadcast_id__in=exclude)
+        .order_by("-broadcast__priority", "broadcast__created_at", "index")
+        .values_list("id", flat=True)[:10]
+    )
+    for shard_id in candidates:
+        claimed = (
+            BroadcastShard.objects
+            .filter(claimable(now), id=shard_id)
+            .update(status="inprogress", worker=WORKER_ID, lease_expires_at=now + LEASE)
+        )
+        if claimed:
+            return BroadcastShard.objects.select_related("broadcast__media").get(id=shard_id)
+    return None
+
+
+def plan_next_broadcast():
+    """Split the most urgent, then oldest, unplanned broadcast that is due into shards.
+
+    Return False when there is nothing to plan. A recurring broadcast queues its next
+    occurrence in the same transaction.
+    """
+    now = timezone.now()
+    broadcast = (
+        Broadcast.objects
+        .filter(due(now), status__in=["pending", "inprogress"], shards__isnull=True)
+        .order_by("-priority", "created_at")
+        .first()
+    )
+    if not broadcast:
+        return False
+
+    if broadcast.segment_id:
+        broadcast.segment = ensure_built(broadcast.segment)
+    shards, total_target_users = split_into_shards(broadcast)
+    if broadcast.delivery_window:
+        # Shard i may start i / n of the way into the window; each is then paced to last its share of it
+        for shard in shards:
+            shard.not_before = now + broadcast.delivery_window * shard.index / len(shards)
+    try:
+        with transaction.atomic():
+            # The unique (broadcast, index) constraint makes a concurrent planner fail here
+            BroadcastShard.objects.bulk_create(shards)
+            if broadcast.recurrence:
+                broadcast.schedule_next(now)
+            Broadcast.objects.filter(id=broadcast.id).update(
+                status="inprogress" if shards else "completed",
+                total_target_users=total_target_users,
+                segment_version=broadcast.segment.version if broadcast.segment_id else None,
+                updated_at=timezone.now(),
+            )
+    except IntegrityError:
+        return True  # Another worker planned it first
+    if not shards and broadcast.segment_id:
+        release_segment(broadcast.segment_id)
+    publish({"id": broadcast.id, "status": "inprogress" if shards else "completed",
+             "total_target_users": total_target_users})
+    return True
+
+
+def next_due_in(limit):
+    """Seconds until the next scheduled broadcast or held back shard is due, at most ``limit``."""
+    now = timezone.now()
+    scheduled = (
+        Broadcast.objects
+        .filter(status="pending", scheduled_at__gt=now)
+        .order_by("scheduled_at")
+        .values_list("scheduled_at", flat=True)
+        .first()
+    )
+    held_back = (
+        BroadcastShard.objects
+        .filter(status="pending", not_before__gt=now)
+        .order_by("not_before")
+        .values_list("not_before", flat=True)
+        .first()
+    )
+    due_at = min((at for at in (scheduled, held_back) if at is not None), default=None)
+    if due_at is None:
+        return limit
+    return min((due_at - now).total_seconds(), limit)
+
+
+def split_into_shards(broadcast):
+    """Return unsaved shards covering every recipient of a broadcast, and the recipient count.
+
+    Shards are position ranges in the merged, packed list of an explicit audience, else
+    ``User.id`` ranges over the members of its segment or over every user. Users who have
+    blocked the bot are not counted. A segment's size is read from its cached recipient
+    set rather than counted.
+    """
+    if broadcast.targeted:
+        recipients = broadcast.merged_recipients()
+        blocked = RecipientSet.from_sorted(
+            User.objects.filter(blocked=True).order_by("telegram_id").values_list("telegram_id", flat=True).iterator()
+        )
+        stats = {"total": len(recipients), "first": 0, "last": len(recipients) - 1}
+        total = len(recipients) - len(recipients.intersection(blocked))
+    elif broadcast.segment_id:
+        stats = SegmentMember.objects.filter(segment=broadcast.segment_id).aggregate(first=Min("user_id"),
+                                                                                       last=Max("user_id"))
+        stats["total"] = total = broadcast.segment.size
+    else:
+        stats = User.objects.filter(blocked=False).aggregate(total=Count("id"), first=Min("id"), last=Max("id"))
+        total = stats["total"]
+
+    bounds = []
+    if stats["total"]:
+        width = math.ceil((stats["last"] - stats["first"] + 1) / math.ceil(stats["total"] / settings.BROADCAST_SHARD_SIZE))
+        bounds = [(start, min(start + width, stats["last"] + 1))
+                  for start in range(stats["first"], stats["last"] + 1, width)]
+    shards = [BroadcastShard(broadcast=broadcast, index=index, start=start, end=end)
+              for index, (start, end) in enumerate(bounds)]
+    return shards, total
+
+
+def renew_lease(shard, force=False):
+    """Extend this worker's claim on a shard. Return False if another worker has taken it over.
+
+    Without ``force`` the lease is only written once a third of it has elapsed, so this is
+    cheap enough to call after every batch.
+    """
+    now = timezone.now()
+    if not force and shard.lease_expires_at - now > LEASE * 2 / 3:
+        return True
+    renewed = (
+        BroadcastShard.objects
+        .filter(id=shard.id, worker=WORKER_ID, status="inprogress")
+        .update(lease_expires_at=now + LEASE)
+    )
+    if renewed:
+        shard.lease_expires_at = now + LEASE  # Left as it was when lost, so every later call reports it
+    return bool(renewed)
+
+
+def release_lease(shard):
+    """Give up this worker's claim on a shard it has not finished, so another worker may resume it at once."""
+    BroadcastShard.objects.filter(id=shard.id, worker=WORKER_ID, status="inprogress").update(
+        lease_expires_at=timezone.now()
+    )
+
+
+def complete_shard(shard):
+    """Mark a shard done. Return True if it was the broadcast's last one and the broadcast is now completed."""
+    BroadcastShard.objects.filter(id=shard.id, worker=WORKER_ID).update(status="completed")
+    if BroadcastShard.objects.filter(broadcast_id=shard.broadcast_id).exclude(status="completed").exists():
+        return False
+    completed = (
+        Broadcast.objects
+        .filter(id=shard.broadcast_id, status="inprogress")
+        .update(status="completed", updated_at=timezone.now())
+    )
+    if completed:
+        if shard.broadcast.segment_id:
+            release_segment(shard.broadcast.segment_id)
+        totals = (
+            Broadcast.objects
+            .filter(id=shard.broadcast_id)
+            .values("total_target_users", "total_successful", "total_failed")
+            .get()
+        )
+        publish({"id": shard.broadcast_id, "status": "completed", **totals})
+    return bool(completed)
+
+
+def claim_upload(media):
+    """Take the upload of ``media`` to Telegram, which no other worker may do while it lasts. Return True if taken.
+
+    Otherwise ``media.file_id`` is reloaded, and is still None while another worker uploads
+    it. A claim runs out after the shard lease unless ``renew_upload`` keeps it, in case its
+    worker died mid-upload.
+    """
+    now = timezone.now()
+    claimed = (
+        Media.objects
+        .filter(Q(upload_expires_at__isnull=True) | Q(upload_expires_at__lt=now), id=media.id, file_id__isnull=True)
+        .update(upload_expires_at=now + LEASE, upload_worker=WORKER_ID)
+    )
+    if not claimed:
+        media.refresh_from_db(fields=["file_id"])
+    return bool(claimed)
+
+
+def renew_upload(media):
+    """Extend this worker's upload claim on ``media``. Return False if it ran out and another worker took it over."""
+    now = timezone.now()
+    renewed = (
+        Media.objects
+        .filter(id=media.id, file_id__isnull=True, upload_worker=WORKER_ID)
+        .update(upload_expires_at=now + LEASE)
+    )
+    return bool(renewed)
+
+
+def store_file_id(media, file_id):
+    """Keep the file_id of an uploaded ``media`` for every later send, and end this worker's upload claim.
+
+    If the claim was taken over meanwhile, the new holder's upload is left to store its own.
+    """
+    Media.objects.filter(id=media.id, upload_worker=WORKER_ID).update(
+        file_id=file_id, upload_expires_at=None, upload_worker=""
+    )
+    media.file_id = file_id
+
+
+def release_upload(media):
+    """Give up this worker's upload claim on ``media`` without a file_id, so another worker may upload it."""
+    Media.objects.filter(id=media.id, file_id__isnull=True, upload_worker=WORKER_ID).update(
+        upload_expires_at=None, upload_worker=""
+    )
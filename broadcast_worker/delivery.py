@@ -0,0 +1,266 @@
+import asyncio
+import collections
+import itertools
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import BinaryField, Exists, F, OuterRef
+from django.db.models.functions import Substr
+from django.utils import timezone
+
+from broadcast.audience import RecipientSet
+from broadcast.models import Broadcast, BroadcastTarget, RecipientList, User
+from broadcast.segments import refresh_segments
+from broadcast_worker.claims import renew_lease
+from broadcast_worker.metrics import DELIVERIES, FLUSH_LATENCY, delivery_outcome
+from broadcast_worker.retry import BLOCKED, SENT
+
+
+def recipient_pages(shard, page_size):
+    """Yield the telegram ids of a shard that have no recorded delivery yet, ``page_size`` at a time.
+
+    Recipients already delivered to by an earlier, interrupted run are skipped, so a
+    worker taking over a shard resumes after the last committed batch. Users known to
+    have blocked the bot are skipped as well. Pages of users are read by keyset
+    (``id > last_id``), so each one is a short indexed query and memory stays constant;
+    an explicit audience is sliced out of its packed list instead.
+    """
+    broadcast = shard.broadcast
+    if broadcast.targeted:
+        yield from recipient_list_pages(shard, page_size)
+        return
+    done = (
+        BroadcastTarget.objects
+        .filter(broadcast=broadcast, telegram_id=OuterRef("telegram_id"))
+        .exclude(status="pending")
+    )
+    if broadcast.segment_id:
+        # The segment's cached members, read through its (segment, user) index
+        queryset = (
+            User.objects
+            .filter(segment_memberships__segment=broadcast.segment_id, blocked=False)
+            .exclude(Exists(done))
+        )
+    else:
+        # A correlated NOT EXISTS probes the (broadcast, telegram_id) index once per user, where
+        # NOT IN would collect every recorded delivery of the broadcast again for each page
+        queryset = User.objects.filter(blocked=False).exclude(Exists(done))
+
+    last_id = shard.start - 1
+    while True:
+        rows = list(
+            queryset
+            .filter(id__gt=last_id, id__lt=shard.end)
+            .order_by("id")
+            .values_list("id", "telegram_id")[:page_size]
+        )
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        yield [telegram_id for _, telegram_id in rows]
+
+
+def recipient_list_pages(shard, page_size):
+    """Yield the unsent recipients of an explicit audience's shard as int64 arrays of up to ``page_size``.
+
+    Only the shard's byte range of the packed list is read from the database, and pages
+    are zero-copy slices of it. Each page is checked against the recorded deliveries and
+    blocked users with two indexed ``IN`` queries.
+    """
+    width = RecipientSet.ITEM_SIZE
+    packed = (
+        RecipientList.objects
+        .filter(broadcast=shard.broadcast_id, merged=True)
+        .annotate(shard_ids=Substr("ids", shard.start * width + 1, (shard.end - shard.start) * width,
+                                   output_field=BinaryField()))
+        .values_list("shard_ids", flat=True)
+        .get()
+    )
+    ids = memoryview(RecipientSet.from_bytes(packed).ids)
+    for start in range(0, len(ids), page_size):
+        page = RecipientSet(ids[start:start + page_size])
+        done = (
+            BroadcastTarget.objects
+            .filter(broadcast=shard.broadcast_id, telegram_id__in=page)
+            .exclude(status="pending")
+            .order_by("telegram_id")
+            .values_list("telegram_id", flat=True)
+        )
+        blocked = User.objects.filter(blocked=True, telegram_id__in=page).order_by("telegram_id").values_list(
+            "telegram_id", flat=True)
+        unsent = page.difference(RecipientSet.from_sorted(done).union(RecipientSet.from_sorted(blocked)))
+        if unsent:
+            yield unsent.ids
+
+
+def recipients(shard, page_size):
+    """Iterate over the recipients of a shard one by one, reading them a page at a time."""
+    return itertools.chain.from_iterable(recipient_pages(shard, page_size))
+
+
+class RecipientStream:
+    """Recipients of a shard for the async worker, with the next page read while the current one is sent.
+
+    Call ``fill`` before taking recipients; iterating only drains what is already buffered.
+    """
+
+    def __init__(self, shard, page_size):
+        self.pages = recipient_pages(shard, page_size)
+        self.buffer = collections.deque()
+        self.prefetch = None
+        self.exhausted = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.buffer:
+            raise StopIteration
+        return self.buffer.popleft()
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def fetch_next_page(self):
+        self.prefetch = asyncio.ensure_future(sync_to_async(next)(self.pages, None))
+
+    async def fill(self, count):
+        """Buffer at least ``count`` recipients, unless the shard runs out first."""
+        while len(self.buffer) < count and not self.exhausted:
+            if self.prefetch is None:
+                self.fetch_next_page()
+            page = await self.prefetch
+            if page is None:
+                self.prefetch = None
+                self.exhausted = True
+            else:
+                self.buffer.extend(page)
+                self.fetch_next_page()
+
+    def close(self):
+        if self.prefetch is not None:
+            self.prefetch.cancel()
+
+
+def record_results(shard, results):
+    """Persist per-recipient outcomes, add them to the broadcast's totals and renew the shard's lease.
+
+    ``results`` is a list of ``(telegram_id, outcome)`` pairs with a terminal outcome from
+    ``retry``. The lease is renewed first, in the same transaction, and nothing is written
+    if it was lost: the worker that took the shard over sends and records it instead.
+    Recipients that already have a recorded outcome are left out, so a write that is
+    repeated, or that overlaps with another worker's, never counts anyone twice. The other
+    targets are upserted in one statement and the totals incremented in place, so several
+    workers can report on one broadcast. Users that turned out to have blocked the bot are
+    flagged, and leave their segments, in the same transaction. Returns False if the
+    shard's lease was lost.
+    """
+    if not results:
+        return renew_lease(shard)
+    with transaction.atomic():
+        # First, so the write lock is held while the recorded outcomes are read
+        if not renew_lease(shard, force=True):
+            return False
+        outcomes = dict(results)
+        recorded = (
+            BroadcastTarget.objects
+            .filter(broadcast=shard.broadcast_id, telegram_id__in=outcomes)
+            .exclude(status="pending")
+            .values_list("telegram_id", flat=True)
+        )
+        for telegram_id in recorded:
+            del outcomes[telegram_id]
+        if not outcomes:
+            return True
+        now = timezone.now()
+        targets = [
+            BroadcastTarget(
+                broadcast_id=shard.broadcast_id,
+                telegram_id=telegram_id,
+                status="sent" if outcome == SENT else "failed",
+                sent_at=now if outcome == SENT else None,
+            )
+            for telegram_id, outcome in outcomes.items()
+        ]
+        successful = sum(1 for outcome in outcomes.values() if outcome == SENT)
+        blocked = [telegram_id for telegram_id, outcome in outcomes.items() if outcome == BLOCKED]
+        BroadcastTarget.objects.bulk_create(
+            targets,
+            update_conflicts=True,
+            unique_fields=["broadcast", "telegram_id"],
+            update_fields=["status", "sent_at"],
+        )
+        Broadcast.objects.filter(id=shard.broadcast_id).update(
+            total_successful=F("total_successful") + successful,
+            total_failed=F("total_failed") + len(outcomes) - successful,
+            updated_at=now,
+        )
+        if blocked:
+            User.objects.filter(telegram_id__in=blocked).update(blocked=True)
+            refresh_segments(User.objects.filter(telegram_id__in=blocked))
+    return True
+
+
+class ResultRecorder:
+    """Buffers the outcomes of a shard and hands them to ``record_results`` in the background.
+
+    A write starts once ``BROADCAST_COMMIT_SIZE`` outcomes are buffered or
+    ``BROADCAST_COMMIT_INTERVAL`` seconds have passed since the last one. ``submit(fn, *args)``
+    runs it off the sending path and returns a future. Only one write is in flight at a time;
+    outcomes that arrive meanwhile go into the next one, so the number of writes is bounded
+    by time rather than by the number of messages sent.
+    """
+
+    COMMIT_SIZE = settings.BROADCAST_COMMIT_SIZE
+    COMMIT_INTERVAL = settings.BROADCAST_COMMIT_INTERVAL
+
+    def __init__(self, shard, submit):
+        self.shard = shard
+        self.submit = submit
+        self.pending = []
+        self.inflight = None
+        self.owned = True
+        self.flushed_at = time.monotonic()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, telegram_id, outcome):
+        self.pending.append((telegram_id, outcome))
+        DELIVERIES.labels(delivery_outcome(outcome)).inc()
+
+    def record(self, results):
+        with FLUSH_LATENCY.time():
+            return record_results(self.shard, results)
+
+    def poll(self):
+        """Collect a finished write and start the next one if it is due. Return False once the lease was lost."""
+        if self.inflight is not None and self.inflight.done():
+            self.owned = self.inflight.result() and self.owned
+            self.inflight = None
+        due = len(self.pending) >= self.COMMIT_SIZE or time.monotonic() - self.flushed_at >= self.COMMIT_INTERVAL
+        if self.inflight is None and self.pending and due:
+            self.inflight = self.submit(self.record, self.pending)
+            self.pending = []
+            self.flushed_at = time.monotonic()
+        return self.owned
+
+    def finish(self):
+        """Wait for the write in flight, then record what is left. Return False if the lease was lost."""
+        if self.inflight is not None:
+            self.owned = self.inflight.result() and self.owned
+            self.inflight = None
+        pending, self.pending = self.pending, []
+        self.owned = self.record(pending) and self.owned
+        return self.owned
+
+    async def finish_async(self):
+        """Like ``finish``, for the async worker, whose ``submit`` returns asyncio futures."""
+        if self.inflight is not None:
+            self.owned = await self.inflight and self.owned
+            self.inflight = None
+        pending, self.pending = self.pending, []
+        self.owned = await sync_to_async(self.record)(pending) and self.owned
+        return self.owned
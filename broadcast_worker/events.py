@@ -0,0 +1,89 @@
+import asyncio
+import json
+import time
+
+from django.conf import settings
+
+from broadcast_worker.retry import SENT
+from broadcast_worker.wakeup import Wakeup, send_all
+
+EVENTS_DIR = settings.BROADCAST_EVENTS_DIR
+INTERVAL = settings.BROADCAST_EVENTS_INTERVAL
+
+
+def publish(event):
+    """Send a progress event to every web process on this host that has a client streaming progress."""
+    send_all(EVENTS_DIR, json.dumps(event, separators=(",", ":")).encode())
+
+
+class ProgressPublisher:
+    """Counts the outcomes of one shard and publishes them as deltas, at most once per ``INTERVAL``.
+
+    The deltas are published as messages are sent, before they are recorded in the
+    database, so clients see progress long before the next commit.
+    """
+
+    def __init__(self, broadcast_id):
+        self.broadcast_id = broadcast_id
+        self.successful = 0
+        self.failed = 0
+        self.published_at = time.monotonic()
+
+    def add(self, outcome):
+        if outcome == SENT:
+            self.successful += 1
+        else:
+            self.failed += 1
+        if time.monotonic() - self.published_at >= INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if self.successful or self.failed:
+            publish({"id": self.broadcast_id, "status": "inprogress",
+                     "successful": self.successful, "failed": self.failed})
+        self.successful = self.failed = 0
+        self.published_at = time.monotonic()
+
+
+class ProgressHub:
+    """Receives the events workers publish and hands each one to every open progress stream.
+
+    The process's socket in ``BROADCAST_EVENTS_DIR`` is only bound while a stream is open,
+    so workers do not publish to web processes nobody is listening to. A stream that
+    falls ``MAX_QUEUED`` events behind misses the newest ones.
+    """
+
+    MAX_QUEUED = 1000
+
+    def __init__(self):
+        self.queues = set()
+        self.inbox = None
+
+    def subscribe(self):
+        if self.inbox is None:
+            self.inbox = Wakeup(EVENTS_DIR)
+            if self.inbox.sock is not None:
+                asyncio.get_running_loop().add_reader(self.inbox.sock.fileno(), self.dispatch)
+        queue = asyncio.Queue(self.MAX_QUEUED)
+        self.queues.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self.queues.discard(queue)
+        if not self.queues and self.inbox is not None:
+            if self.inbox.sock is not None:
+                asyncio.get_running_loop().remove_reader(self.inbox.sock.fileno())
+            self.inbox.close()
+            self.inbox = None
+
+    def dispatch(self):
+        for message in self.inbox.receive():
+            event = json.loads(message)
+            for queue in self.queues:
+                try:
+                    queue.put_nowait(event)
+                except asyncio.QueueFull:
+                    pass
+
+
+hub = ProgressHub()
@@ -1,141 +1,197 @@
-import os
+import signal
+import threading
 import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from django.core.management.base import BaseCommand
+from django.db import connection
 
-from broadcast.models import Broadcast, User
+from broadcast_worker.claims import next_due_in, renew_lease, store_file_id
+from broadcast_worker.delivery import recipients
+from broadcast_worker import metrics
+from broadcast_worker.payload import JSON_HEADERS
+from broadcast_worker.profiling import profiled
+from broadcast_worker.retry import RETRY, SENT, classify
+from broadcast_worker.sender import SenderCommand
+from broadcast_worker.wakeup import Wakeup
 
 import requests
+from requests.adapters import HTTPAdapter
 
 
-class Command(BaseCommand):
+class Command(SenderCommand):
     help = "Processes pending broadcasts and sends messages to users"
 
-    BOT_TOKEN = os.environ.get("BOT_TOKEN")
-    if not BOT_TOKEN:
-        exit("BOT_TOKEN environment variable not set")
-    RATE_LIMIT = 30  # Telegram allows 30 messages per second
     BATCH_SIZE = 30  # Number of users to process in one batch
-    TELEGRAM_BOT_API_URL = "https://api.telegram.org/bot{}".format(BOT_TOKEN)
     MAX_WORKERS = 30
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self.local = threading.local()
+        self.executor = None
+        self.writer = None
+        self.stopped = threading.Event()
 
     def handle(self, *args, **kwargs):
         self.stdout.write("Starting the broadcast script...")
+        # One long-lived pool for the whole process; every worker thread keeps its own session
+        self.executor = ThreadPoolExecutor(max_workers=self.MAX_WORKERS, initializer=self.init_worker)
+        # A single thread records results, so sending carries on while the database is written
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.wakeup = Wakeup()
+        threading.Thread(target=self.heartbeat, daemon=True).start()
+        self.serve_metrics()
+        signal.signal(signal.SIGTERM, self.stop)
         try:
             self.process_broadcast()
+            self.stdout.write("Broadcast script stopped.")
         except KeyboardInterrupt:
             self.stdout.write("Broadcast script terminated by user.")
-
-    def send_message(self, chat_id, broadcast):
-        payload = {
-            'chat_id': chat_id,
-        }
-        if broadcast.type == "text":
-            url = f"{self.TELEGRAM_BOT_API_URL}/sendMessage"
-            payload["text"] = broadcast.message
-        elif broadcast.type == "image":
-            url = f"{self.TELEGRAM_BOT_API_URL}/sendPhoto"
-            payload['photo'] = broadcast.file_id
-            payload["caption"] = broadcast.message
-        elif broadcast.type == "video":
-            url = f"{self.TELEGRAM_BOT_API_URL}/sendVideo"
-            payload['video'] = broadcast.file_id
-            payload["caption"] = broadcast.message
-
-        if broadcast.buttons:
-            inline_keyboard = []
-            for btn in broadcast.buttons:
-                if btn["web_app"]:
-                    inline_keyboard.append([{"text": btn["text"], "web_app": {"url": btn["url"]}}])
-                else:
-                    inline_keyboard.append([{"text": btn["text"], "url": btn["url"]}])
-
-            payload["reply_markup"] = {"inline_keyboard": inline_keyboard}
-
+        finally:
+            self.stopped.set()
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.release_runs()
+            self.writer.shutdown()
+            self.wakeup.close()
+
+    def init_worker(self):
+        """Open a keep-alive session for the current worker thread."""
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        self.local.session = session
+
+    @property
+    def session(self):
+        if not hasattr(self.local, "session"):
+            self.init_worker()
+        return self.local.session
+
+    @profiled
+    def send_message(self, chat_id, payload):
+        """Send one message. Return ``(outcome, retry_after)`` as classified by ``retry.classify``."""
+        metrics.PACER_WAIT.observe(self.pacer.acquire(chat_id))
+        uploading = payload.needs_upload
         try:
-            response = requests.post(url, json=payload)
-            response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
-            return True
-        except requests.exceptions.RequestException as e:
+            with metrics.IN_FLIGHT.track_inprogress(), metrics.SEND_LATENCY.time():
+                if uploading:
+                    upload = (payload.media.filename or "file", payload.read_media(), payload.media.content_type or None)
+                    response = self.session.post(payload.url, data=payload.upload_fields(chat_id),
+                                                 files={payload.file_field: upload}, timeout=self.UPLOAD_TIMEOUT)
+                else:
+                    response = self.session.post(payload.url, data=payload.render(chat_id), headers=JSON_HEADERS,
+                                                 timeout=self.REQUEST_TIMEOUT)
+        except OSError as e:  # Also a requests.exceptions.RequestException, or the media file failing to read
             # self.stderr.write(f"Failed to send message: {e}")
-            return False
-
+            metrics.SENDS.labels(metrics.send_result(None, RETRY)).inc()
+            return RETRY, None
+        try:
+            body = response.json()
+        except ValueError:
+            body = None
+        outcome, retry_after, _ = classify(response.status_code, body)
+        metrics.SENDS.labels(metrics.send_result(response.status_code, outcome)).inc()
+        if retry_after:
+            # Flood wait: hold back every thread, not just this one
+            self.pacer.pause(retry_after)
+        if uploading and outcome == SENT and payload.file_id_from(body):
+            # Every later send, from any thread, goes by the file_id instead of uploading again
+            payload.use_file_id(payload.file_id_from(body))
+        return outcome, retry_after
+
+    @profiled
     def process_broadcast(self):
-        while True:
-            # Fetch the oldest pending broadcast
-            broadcast = (
-                Broadcast.objects
-                .filter(status="pending")
-                .order_by("created_at")
-                .first()
-            )
-
-            if not broadcast:
-                # self.stdout.write("No pending broadcasts. Sleeping for 10 seconds...")
-                time.sleep(10)
+        while not self.stopping:
+            # Take on shards of other broadcasts while there is room, so they are sent side by side
+            claim_due = self.wakeup.notified() or time.monotonic() >= self.next_claim
+            if len(self.scheduler) < self.ACTIVE_SHARDS and claim_due:
+                if not self.claim_runs():
+                    # Nothing is free; look again once the next scheduled broadcast is due
+                    self.next_claim = time.monotonic() + next_due_in(self.POLL_INTERVAL)
+
+            if not self.scheduler:
+                # Sleep until a new broadcast is created or a scheduled one is due, polling again
+                # after POLL_INTERVAL at the latest
+                self.wakeup.wait(max(self.next_claim - time.monotonic(), 0))
+                self.next_claim = 0
+                continue
+
+            run, user_batch = self.next_batch()
+            if run is None:
+                # Only retries and paced sends are left; wait for the next one to come due
+                timeout = min(self.scheduler.next_due_in(), self.POLL_INTERVAL)
+                if len(self.scheduler) < self.ACTIVE_SHARDS:
+                    timeout = min(timeout, max(self.next_claim - time.monotonic(), 0))
+                if self.wakeup.wait(timeout):
+                    self.next_claim = 0
+                self.renew_leases()
                 continue
 
-            self.stdout.write(f"Processing broadcast ID: {broadcast.id}")
-            broadcast.status = "inprogress"
-            broadcast.save()
-
-            # Update total targeted users
-            total_targeted_users = len(broadcast.users) if broadcast.users else User.objects.count()
-            broadcast.total_target_users = total_targeted_users
-            broadcast.save(update_fields=["total_target_users"])
-
-            successful = 0
-            failed = 0
-
-            # Process users in batches
-            if broadcast.users:
-                users = broadcast.users
-            else:
-                users = User.objects.values_list("telegram_id", flat=True).iterator(chunk_size=self.BATCH_SIZE)
-
-            batch_no = 0
-            for user_batch in self.batch_iterator(users, self.BATCH_SIZE):
-                results = []
-                batch_no += 1
-                print(f"Processing batch {batch_no} with {len(user_batch)} users...")
-                with ThreadPoolExecutor(max_workers=self.MAX_WORKERS) as executor:
-                    future_to_url = {executor.submit(self.send_message, user_id, broadcast): user_id for user_id in
-                                     user_batch}
-                    for future in as_completed(future_to_url):
-                        results.append(future.result())
-
-                # Handle results
-                for result in results:
-                    if result is False:
-                        failed += 1
-                    else:
-                        successful += 1
-
-                time.sleep(1)
-
-                # Update progress incrementally in the database
-                broadcast.total_successful = successful
-                broadcast.total_failed = failed
-                broadcast.save(update_fields=["total_successful", "total_failed"])
-
-            # Mark broadcast as completed
-            broadcast.total_successful = successful
-            broadcast.total_failed = failed
-            broadcast.status = "completed"
-            broadcast.save()
-            self.stdout.write(f"Broadcast {broadcast.id} completed: {successful} successful, {failed} failed.")
-
-    def batch_iterator(self, iterator, batch_size):
-        """Helper function to yield batches from an iterator."""
-        batch = []
-        for item in iterator:
-            batch.append(item)
-            if len(batch) == batch_size:
-                yield batch
-                batch = []
-        if batch:
-            yield batch
+            future_to_url = {self.executor.submit(self.send_message, user_id, run.payload): user_id for user_id in
+                             user_batch}
+
+            # Handle results
+            for future in as_completed(future_to_url):
+                user_id = future_to_url[future]
+                outcome, retry_after = future.result()
+                run.add_result(user_id, outcome, retry_after)
+            self.scheduler.charge(run, len(user_batch))
+            if run.uploading and not run.payload.needs_upload:
+                store_file_id(run.payload.media, run.payload.file_id)
+                run.uploading = False
+
+            # Deliveries and progress are recorded in the background, many batches per transaction
+            self.renew_leases()
+
+    def read_recipients(self, shard):
+        return recipients(shard, self.PAGE_SIZE)
+
+    def submit_write(self, fn, *args):
+        return self.writer.submit(fn, *args)
+
+    def next_batch(self):
+        """Return the run to send next and its batch, finishing runs that are done.
+
+        Runs are tried in fair-queuing order, each mixing in its transient failures once
+        their retry is due. Return ``(None, [])`` if every run is waiting for retries or for
+        the pace of its delivery window.
+        """
+        for run in self.scheduler.in_order():
+            if run.due_in():
+                continue  # Held back by its delivery window or another worker's upload
+            if run.payload.needs_upload and not self.start_upload(run):
+                continue
+            user_batch = run.retries.next_batch(run.users, self.batch_size(run))
+            if user_batch:
+                return run, user_batch
+            if not run.retries:
+                self.finish_run(run)
+        return None, []
+
+    def renew_leases(self):
+        """Start due result writes and renew every lease, dropping the shards another worker took over."""
+        for run in self.scheduler:
+            if not (run.recorder.poll() and renew_lease(run.shard)):
+                self.drop_run(run, lost=True)
+
+    def heartbeat(self):
+        """Run ``renew_claims`` every ``HEARTBEAT_INTERVAL`` from a thread of its own until the command stops."""
+        try:
+            while not self.stopped.wait(self.HEARTBEAT_INTERVAL):
+                self.renew_claims()
+        finally:
+            connection.close()
+
+    def release_runs(self):
+        """Record what every run has buffered and release its shard, before the writer shuts down.
+
+        Otherwise the buffered recipients would be sent again when the shard is resumed.
+        """
+        for run in list(self.scheduler):
+            self.release_run(run, run.recorder.finish())
+
+    def finish_run(self, run):
+        owned = run.recorder.finish()
+        self.drop_run(run, lost=not owned)
+        if owned:
+            self.complete_run(run)
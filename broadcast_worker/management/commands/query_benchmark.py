@@ -0,0 +1,132 @@
+import itertools
+import statistics
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import BinaryField, Exists, Max, Min, OuterRef
+from django.db.models.functions import Substr
+from django.utils import timezone
+
+from broadcast.models import Broadcast, BroadcastTarget, RecipientList, User
+from broadcast_worker.claims import claimable, due
+from broadcast_worker.models import BroadcastShard
+
+
+class Command(BaseCommand):
+    help = ("Prints the plan and median time of the worker's and the API's hot queries. "
+            "--users, --broadcasts and --targets first fill the database up to that size; "
+            "point DB_NAME at a scratch database for that.")
+
+    BATCH_SIZE = 10000  # Rows inserted per query while seeding
+    SHARDS = 10  # Shards per seeded broadcast
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=0, help="Seed users up to this many")
+        parser.add_argument("--broadcasts", type=int, default=0, help="Seed broadcasts up to this many")
+        parser.add_argument("--targets", type=int, default=0,
+                            help="Seed an in-progress explicit audience of this many recipients, half of them sent")
+        parser.add_argument("--repeat", type=int, default=20, help="Runs per query")
+
+    def handle(self, *args, **options):
+        self.seed(options["users"], options["broadcasts"], options["targets"])
+        self.stdout.write(f"{User.objects.count()} users, {Broadcast.objects.count()} broadcasts, "
+                          f"{BroadcastTarget.objects.count()} targets, {BroadcastShard.objects.count()} shards\n\n")
+        for name, queryset in self.queries():
+            timings = []
+            for _ in range(options["repeat"]):
+                started = time.perf_counter()
+                list(queryset.all())  # A fresh clone each time, so the result cache is not reused
+                timings.append(time.perf_counter() - started)
+            self.stdout.write(f"{name}: {statistics.median(timings) * 1000:.2f} ms")
+            for line in queryset.explain().splitlines():
+                self.stdout.write(f"    {line}")
+
+    def seed(self, users, broadcasts, targets):
+        with transaction.atomic():
+            last = User.objects.aggregate(last=Max("telegram_id"))["last"] or 0
+            missing = users - User.objects.count()
+            telegram_ids = iter(range(last + 1, last + 1 + max(missing, 0)))
+            # One user in a hundred has blocked the bot
+            while batch := list(itertools.islice(telegram_ids, self.BATCH_SIZE)):
+                User.objects.bulk_create([User(telegram_id=telegram_id, blocked=telegram_id % 100 == 0)
+                                          for telegram_id in batch])
+
+            # Mostly finished broadcasts with a few still queued or sending, spread over the last year
+            now = timezone.now()
+            statuses = ["completed"] * 97 + ["pending", "inprogress", "draft"]
+            missing = broadcasts - Broadcast.objects.count()
+            for offset in range(0, max(missing, 0), self.BATCH_SIZE):
+                created = Broadcast.objects.bulk_create([
+                    Broadcast(message=f"Weekly sale #{number}" if number % 10 == 0 else f"Update #{number}",
+                              status=statuses[number % len(statuses)])
+                    for number in range(offset, min(offset + self.BATCH_SIZE, missing))
+                ])
+                # auto_now_add ignores given values, so spread the creation times afterwards
+                for broadcast in created:
+                    broadcast.created_at = broadcast.updated_at = now - timedelta(minutes=broadcast.id % 525600)
+                Broadcast.objects.bulk_update(created, ["created_at", "updated_at"], batch_size=self.BATCH_SIZE)
+                BroadcastShard.objects.bulk_create([
+                    BroadcastShard(broadcast=broadcast, index=index, start=index * 10000, end=(index + 1) * 10000,
+                                   status="completed" if broadcast.status == "completed" else "pending")
+                    for broadcast in created if broadcast.status != "draft"
+                    for index in range(self.SHARDS)
+                ], batch_size=self.BATCH_SIZE)
+
+            if targets and not Broadcast.objects.filter(targeted=True, status="inprogress").exists():
+                broadcast = Broadcast.objects.create(message="Targeted", status="inprogress")
+                broadcast.add_recipients(range(1, targets + 1))
+                broadcast.merged_recipients()
+                telegram_ids = iter(range(1, targets + 1, 2))
+                while batch := list(itertools.islice(telegram_ids, self.BATCH_SIZE)):
+                    BroadcastTarget.objects.bulk_create([
+                        BroadcastTarget(broadcast=broadcast, telegram_id=telegram_id, status="sent")
+                        for telegram_id in batch
+                    ])
+
+    def queries(self):
+        """Yield ``(name, queryset)`` for each hot query, as issued by the worker and the API."""
+        now = timezone.now()
+        target_broadcast = Broadcast.objects.filter(targeted=True, status="inprogress").first()
+        targets = BroadcastTarget.objects.filter(broadcast=target_broadcast)
+        stats = User.objects.aggregate(first=Min("id"), last=Max("id"))
+        middle = ((stats["first"] or 0) + (stats["last"] or 0)) // 2
+
+        yield "plan next broadcast", (
+            Broadcast.objects
+            .filter(due(now), status__in=["pending", "inprogress"], shards__isnull=True)
+            .order_by("-priority", "created_at")[:1]
+        )
+        yield "claim shard", (
+            BroadcastShard.objects
+            .filter(claimable(now))
+            .order_by("-broadcast__priority", "broadcast__created_at", "index")
+            .values("id")[:10]
+        )
+        yield "next scheduled broadcast", (
+            Broadcast.objects.filter(status="pending", scheduled_at__gt=now).order_by("scheduled_at").values("scheduled_at")[:1]
+        )
+        yield "list by status", Broadcast.objects.filter(status="pending").order_by("created_at")[:10]
+        yield "list by created_at", (
+            Broadcast.objects.filter(created_at__gte=now - timedelta(days=7)).order_by("created_at")[:10]
+        )
+        yield "list default order", Broadcast.objects.order_by("created_at")[:10]
+        yield "search message", Broadcast.objects.filter(message__icontains="sale").order_by("created_at")[:10]
+        yield "progress since", Broadcast.objects.filter(updated_at__gt=now - timedelta(minutes=5)).order_by("-id")[:10]
+        yield "recipient list shard", (
+            RecipientList.objects
+            .filter(broadcast=target_broadcast, merged=True)
+            .annotate(shard_ids=Substr("ids", 1, 10000 * 8, output_field=BinaryField()))
+            .values_list("shard_ids", flat=True)
+        )
+        yield "target page deliveries", (
+            targets.filter(telegram_id__in=range(1, 2001)).exclude(status="pending").values_list("telegram_id", flat=True)
+        )
+        yield "user page", (
+            User.objects
+            .filter(blocked=False, id__gt=middle, id__lt=middle + 10000)
+            .exclude(Exists(targets.filter(telegram_id=OuterRef("telegram_id")).exclude(status="pending")))
+            .order_by("id")
+            .values_list("id", "telegram_id")[:2000]
+        )
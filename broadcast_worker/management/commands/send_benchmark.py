@@ -0,0 +1,109 @@
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+from django.conf import settings
+from django.core.management import load_command_class
+from django.core.management.base import BaseCommand, CommandError
+
+from broadcast.models import Broadcast, User
+from broadcast_worker.benchmark import FakeBotAPI, SenderStats
+
+
+class Command(BaseCommand):
+    help = ("Sends a broadcast to N seeded users through a local fake Bot API and reports msg/s, "
+            "send latency, database statements and peak RSS of the worker. Run it against a "
+            "scratch database (DB_NAME) with no other unfinished broadcasts.")
+
+    SENDERS = ["broadcast", "send_broadcasts"]
+    SEED_BATCH_SIZE = 10000
+
+    def add_arguments(self, parser):
+        parser.add_argument("sender", choices=self.SENDERS, help="Worker command to benchmark")
+        parser.add_argument("--users", type=int, default=10000, help="Seed users up to this many")
+        parser.add_argument("--rate", type=float, default=settings.BROADCAST_RATE_LIMIT,
+                            help="Messages per second the worker may send (BROADCAST_RATE_LIMIT)")
+        parser.add_argument("--latency", type=float, default=50, help="Milliseconds the fake API takes per request")
+        parser.add_argument("--p429", type=float, default=0.0, help="Share of requests answered with a 429")
+        parser.add_argument("--p403", type=float, default=0.0, help="Share of users who blocked the bot")
+        parser.add_argument("--timeout", type=float, default=3600, help="Seconds to wait for the broadcast")
+        # Internal: run the sender itself and write its stats to this file
+        parser.add_argument("--stats-file", help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options["stats_file"]:
+            return self.run_sender(options["sender"], options["stats_file"])
+
+        if Broadcast.objects.filter(status__in=["pending", "inprogress"]).exists():
+            raise CommandError("There are unfinished broadcasts; point DB_NAME at a scratch database.")
+        self.seed(options["users"])
+        api = FakeBotAPI(latency=options["latency"] / 1000, p429=options["p429"], p403=options["p403"])
+        api.start()
+
+        with tempfile.NamedTemporaryFile(suffix=".json") as stats_file, tempfile.TemporaryFile() as log:
+            env = dict(os.environ, TELEGRAM_BOT_API_URL=api.url, BOT_TOKEN=os.environ.get("BOT_TOKEN") or "benchmark",
+                       BROADCAST_RATE_LIMIT=str(options["rate"]), BROADCAST_WORKER_PROCESSES="1")
+            # The worker's own output, one line per failed send, is only shown if it crashes
+            worker = subprocess.Popen(
+                [sys.executable, str(settings.BASE_DIR / "manage.py"), "send_benchmark", options["sender"],
+                 "--stats-file", stats_file.name],
+                env=env, stdout=subprocess.DEVNULL, stderr=log,
+            )
+            started = time.monotonic()
+            broadcast = Broadcast.objects.create(message="Benchmark")
+            try:
+                while broadcast.status != "completed":
+                    if worker.poll() is not None:
+                        log.seek(0)
+                        self.stderr.write(log.read().decode(errors="replace")[-2000:])
+                        raise CommandError(f"The worker exited with status {worker.returncode}.")
+                    if time.monotonic() - started > options["timeout"]:
+                        raise CommandError("The broadcast did not complete in time.")
+                    time.sleep(0.2)
+                    broadcast.refresh_from_db()
+            except (CommandError, KeyboardInterrupt):
+                # Leave the database ready for the next run
+                worker.kill()
+                broadcast.delete()
+                raise
+            elapsed = time.monotonic() - started
+            worker.send_signal(signal.SIGINT)
+            worker.wait()
+            stats = json.load(stats_file)
+
+        send_time = (api.last_request_at - api.first_request_at) if api.first_request_at else 0
+        delivered = broadcast.total_successful + broadcast.total_failed
+        self.stdout.write(f"{options['sender']}: {delivered} messages to {broadcast.total_target_users} users "
+                          f"in {elapsed:.1f}s")
+        self.stdout.write(f"  throughput    {stats['requests'] / send_time if send_time else 0:.1f} requests/s, "
+                          f"{delivered / elapsed:.1f} msg/s end to end")
+        self.stdout.write(f"  latency       p50 {stats['latency_p50'] * 1000:.1f} ms, "
+                          f"p99 {stats['latency_p99'] * 1000:.1f} ms")
+        self.stdout.write(f"  responses     {', '.join(f'{code}: {count}' for code, count in sorted(api.responses.items()))}")
+        self.stdout.write(f"  outcomes      {broadcast.total_successful} successful, {broadcast.total_failed} failed")
+        self.stdout.write(f"  database      {stats['writes']} writes, {stats['queries']} statements")
+        self.stdout.write(f"  peak RSS      {stats['peak_rss_kb'] / 1024:.1f} MiB")
+        api.shutdown()
+
+    def seed(self, users):
+        last = User.objects.order_by("-telegram_id").values_list("telegram_id", flat=True).first() or 0
+        missing = users - User.objects.count()
+        for start in range(last + 1, last + 1 + max(missing, 0), self.SEED_BATCH_SIZE):
+            User.objects.bulk_create([User(telegram_id=telegram_id)
+                                      for telegram_id in range(start, min(start + self.SEED_BATCH_SIZE, last + 1 + missing))])
+
+    def run_sender(self, name, stats_file):
+        """Run a worker command until interrupted, then write its ``SenderStats`` summary to ``stats_file``."""
+        stats = SenderStats()
+        sender = load_command_class("broadcast_worker", name)
+        stats.instrument(sender)
+        try:
+            sender.handle()
+        finally:
+            with open(stats_file, "w") as f:
+                json.dump(stats.summary(), f)
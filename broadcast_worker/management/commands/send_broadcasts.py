@@ -1,115 +1,197 @@
 import asyncio
-import os
-
-from django.core.management.base import BaseCommand
-
-from broadcast.models import Broadcast, User
-from telegram import Bot
-from telegram.error import TelegramError
+import signal
+import time
+
+from broadcast_worker.claims import next_due_in, renew_lease, store_file_id
+from broadcast_worker.delivery import RecipientStream
+from broadcast_worker import metrics
+from broadcast_worker.payload import JSON_HEADERS
+from broadcast_worker.profiling import profiled
+from broadcast_worker.retry import RETRY, SENT, classify
+from broadcast_worker.sender import SenderCommand
+from broadcast_worker.wakeup import Wakeup
 from asgiref.sync import sync_to_async
 
+import aiohttp
+
 
-class Command(BaseCommand):
+class Command(SenderCommand):
     help = "Processes pending broadcasts and sends messages to users asynchronously"
 
-    BOT_TOKEN = os.environ.get("BOT_TOKEN")
-    if not BOT_TOKEN:
-        exit("BOT_TOKEN environment variable not set")
-    RATE_LIMIT = 30  # Telegram allows 30 messages per second
-    BATCH_SIZE = 30  # Number of users to process in one batch
+    BATCH_SIZE = 500  # Number of users to process in one batch
+    MAX_CONCURRENCY = 200  # Requests in flight at once, sharing one connection pool
+    TRACE_CONFIGS = ()  # aiohttp request tracing hooks, e.g. to time each send
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.bot = Bot(token=self.BOT_TOKEN)
+        self.client = None
+        self.semaphore = None
+        metrics.track_queue("buffered", lambda: sum(len(run.users) for run in self.scheduler))
 
     def handle(self, *args, **kwargs):
         self.stdout.write("Starting the broadcast script asynchronously...")
+        self.wakeup = Wakeup()
+        self.serve_metrics()
         try:
-            asyncio.run(self.process_broadcast())
+            asyncio.run(self.run())
+            self.stdout.write("Broadcast script stopped.")
         except KeyboardInterrupt:
             self.stdout.write("Broadcast script terminated by user.")
-
+        finally:
+            self.wakeup.close()
+
+    async def run(self):
+        """Open the shared HTTP client and process broadcasts with it."""
+        connector = aiohttp.TCPConnector(limit=self.MAX_CONCURRENCY)
+        timeout = aiohttp.ClientTimeout(total=self.REQUEST_TIMEOUT)
+        self.semaphore = asyncio.Semaphore(self.MAX_CONCURRENCY)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers=JSON_HEADERS,
+                                         trace_configs=list(self.TRACE_CONFIGS)) as client:
+            self.client = client
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self.stop)
+            heartbeat = asyncio.ensure_future(self.heartbeat())
+            try:
+                await self.process_broadcast()
+            finally:
+                heartbeat.cancel()
+                # Record what is buffered, or those recipients are sent again on resume
+                for run in list(self.scheduler):
+                    run.users.close()
+                    owned = await run.recorder.finish_async()
+                    await sync_to_async(self.release_run)(run, owned)
+
+    @profiled
     async def process_broadcast(self):
-        while True:
-            # Fetch the oldest pending broadcast asynchronously
-            broadcast = await sync_to_async(self.get_pending_broadcast)()
+        while not self.stopping:
+            # Take on shards of other broadcasts while there is room, so they are sent side by side
+            claim_due = self.wakeup.notified() or time.monotonic() >= self.next_claim
+            if len(self.scheduler) < self.ACTIVE_SHARDS and claim_due:
+                if not await sync_to_async(self.claim_runs)():
+                    # Nothing is free; look again once the next scheduled broadcast is due
+                    self.next_claim = time.monotonic() + await sync_to_async(next_due_in)(self.POLL_INTERVAL)
+
+            if not self.scheduler:
+                # Sleep until a new broadcast is created or a scheduled one is due, polling again
+                # after POLL_INTERVAL at the latest
+                await self.wakeup.wait_async(max(self.next_claim - time.monotonic(), 0))
+                self.next_claim = 0
+                continue
 
-            if not broadcast:
-                self.stdout.write("No pending broadcasts. Sleeping for 10 seconds...")
-                await asyncio.sleep(10)
+            run, user_batch = await self.next_batch()
+            if run is None:
+                # Only retries and paced sends are left; wait for the next one to come due
+                timeout = min(self.scheduler.next_due_in(), self.POLL_INTERVAL)
+                if len(self.scheduler) < self.ACTIVE_SHARDS:
+                    timeout = min(timeout, max(self.next_claim - time.monotonic(), 0))
+                if await self.wakeup.wait_async(timeout):
+                    self.next_claim = 0
+                await self.renew_leases()
                 continue
 
-            self.stdout.write(f"Processing broadcast ID: {broadcast.id}")
-            broadcast.status = "inprogress"
-            await sync_to_async(broadcast.save)()
-
-            # Update total targeted users
-            total_targeted_users = (
-                len(broadcast.users) if broadcast.users else await sync_to_async(User.objects.count)()
-            )
-            broadcast.total_target_users = total_targeted_users
-            await sync_to_async(broadcast.save)(update_fields=["total_target_users"])
-
-            successful, failed = 0, 0
-
-            # Process users in batches
-            users = (
-                broadcast.users
-                if broadcast.users
-                else await sync_to_async(
-                    lambda: list(User.objects.values_list("telegram_id", flat=True))
-                )()
-            )
-
-            for user_batch in self.batch_iterator(users, self.BATCH_SIZE):
-                tasks = [
-                    self.send_message(user_id, broadcast.message) for user_id in user_batch
-                ]
-                results = await asyncio.gather(*tasks, return_exceptions=True)
-
-                # Handle results
-                for result in results:
-                    if isinstance(result, Exception):
-                        failed += 1
-                        self.stderr.write(f"Failed to send message: {result}")
-                    else:
-                        successful += 1
-
-                # Respect Telegram rate limits
-                await asyncio.sleep(1)
-
-                # Update progress incrementally in the database
-                broadcast.total_successful = successful
-                broadcast.total_failed = failed
-                await sync_to_async(broadcast.save)(update_fields=["total_successful", "total_failed"])
-
-            # Mark broadcast as completed
-            broadcast.total_successful = successful
-            broadcast.total_failed = failed
-            broadcast.status = "completed"
-            await sync_to_async(broadcast.save)()
-            self.stdout.write(f"Broadcast {broadcast.id} completed: {successful} successful, {failed} failed.")
-
-    @staticmethod
-    def batch_iterator(iterator, batch_size):
-        """Helper function to yield batches from an iterator."""
-        batch = []
-        for item in iterator:
-            batch.append(item)
-            if len(batch) == batch_size:
-                yield batch
-                batch = []
-        if batch:
-            yield batch
-
-    @staticmethod
-    def get_pending_broadcast():
-        """Fetch the oldest pending broadcast."""
-        return Broadcast.objects.filter(status="pending").order_by("created_at").first()
-
-    async def send_message(self, user_id, message):
-        """Asynchronously send a message using the Telegram bot."""
-        try:
-            await self.bot.send_message(chat_id=user_id, text=message)
-        except TelegramError as e:
-            raise e
+            tasks = [
+                self.send_message(user_id, run.payload) for user_id in user_batch
+            ]
+
+            # Handle results as they arrive, so progress is published while the batch is sent
+            for task in asyncio.as_completed(tasks):
+                run.add_result(*await task)
+            self.scheduler.charge(run, len(user_batch))
+            if run.uploading and not run.payload.needs_upload:
+                await sync_to_async(store_file_id)(run.payload.media, run.payload.file_id)
+                run.uploading = False
+
+            # Deliveries and progress are recorded in the background, many batches per transaction
+            await self.renew_leases()
+
+    def read_recipients(self, shard):
+        return RecipientStream(shard, self.PAGE_SIZE)
+
+    async def next_batch(self):
+        """Return the run to send next and its batch, finishing runs that are done.
+
+        As the threaded command's, with the database calls off the event loop and the
+        chosen run's recipients read ahead of the batch.
+        """
+        for run in self.scheduler.in_order():
+            if run.due_in():
+                continue  # Held back by its delivery window or another worker's upload
+            if run.payload.needs_upload and not await sync_to_async(self.start_upload)(run):
+                continue
+            batch_size = self.batch_size(run)
+            await run.users.fill(batch_size)
+            user_batch = run.retries.next_batch(run.users, batch_size)
+            if user_batch:
+                return run, user_batch
+            if not run.retries:
+                await self.finish_run(run)
+        return None, []
+
+    async def renew_leases(self):
+        """Start due result writes and renew every lease, dropping the shards another worker took over."""
+        for run in self.scheduler:
+            if not (run.recorder.poll() and await sync_to_async(renew_lease)(run.shard)):
+                run.users.close()
+                await sync_to_async(self.drop_run)(run, lost=True)
+
+    async def heartbeat(self):
+        """Run ``renew_claims`` every ``HEARTBEAT_INTERVAL`` until cancelled."""
+        while True:
+            await asyncio.sleep(self.HEARTBEAT_INTERVAL)
+            await sync_to_async(self.renew_claims)()
+
+    async def finish_run(self, run):
+        owned = await run.recorder.finish_async()
+        await sync_to_async(self.drop_run)(run, lost=not owned)
+        if owned:
+            await sync_to_async(self.complete_run)(run)
+
+    def submit_write(self, fn, *args):
+        """Start a database write without waiting for it; it runs on the thread every ``sync_to_async`` call shares."""
+        return asyncio.ensure_future(sync_to_async(fn)(*args))
+
+    @profiled
+    async def send_message(self, user_id, payload):
+        """Send one message through the shared Bot API client.
+
+        Return ``(user_id, outcome, retry_after)`` with the outcome as classified by ``retry.classify``.
+        """
+        uploading = payload.needs_upload
+        async with self.semaphore:
+            metrics.PACER_WAIT.observe(await self.pacer.wait(user_id))
+            try:
+                if uploading:
+                    request = self.client.post(payload.url, **await self.upload_request(user_id, payload))
+                else:
+                    request = self.client.post(payload.url, data=payload.render(user_id))
+                with metrics.IN_FLIGHT.track_inprogress(), metrics.SEND_LATENCY.time():
+                    async with request as response:
+                        try:
+                            body = await response.json(content_type=None)
+                        except ValueError:
+                            body = None
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                self.stderr.write(f"Failed to send message: {e!r}")
+                metrics.SENDS.labels(metrics.send_result(None, RETRY)).inc()
+                return user_id, RETRY, None
+        outcome, retry_after, description = classify(response.status, body)
+        metrics.SENDS.labels(metrics.send_result(response.status, outcome)).inc()
+        if retry_after:
+            # Flood wait: hold back every pending send, not just this one
+            self.pacer.pause(retry_after)
+        if outcome != SENT:
+            self.stderr.write(f"Failed to send message: {response.status} {description}")
+        elif uploading and payload.file_id_from(body):
+            # Every later send goes by the file_id instead of uploading again
+            payload.use_file_id(payload.file_id_from(body))
+        return user_id, outcome, retry_after
+
+    async def upload_request(self, user_id, payload):
+        """Return the arguments of a send to ``user_id`` that carries the media as a multipart form."""
+        form = aiohttp.FormData(payload.upload_fields(user_id))
+        form.add_field(payload.file_field, await sync_to_async(payload.read_media)(),
+                       filename=payload.media.filename or "file",
+                       content_type=payload.media.content_type or "application/octet-stream")
+        body = form()
+        # The client sends JSON by default; the form brings its own content type and boundary
+        return {"data": body, "headers": {"Content-Type": body.content_type},
+                "timeout": aiohttp.ClientTimeout(total=self.UPLOAD_TIMEOUT)}
@@ -0,0 +1,80 @@
+import sys
+
+from django.conf import settings
+from django.db.models import Count
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+from prometheus_client.core import GaugeMetricFamily
+
+from broadcast.models import Broadcast
+from broadcast_worker.models import BroadcastShard
+from broadcast_worker.retry import BLOCKED, FAILED, SENT
+
+# Sub-second buckets for single requests and writes, up to the 30 s request timeout
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+SENDS = Counter("broadcast_sends_total", "Bot API send attempts, by result", ["result"])
+DELIVERIES = Counter("broadcast_deliveries_total", "Recipients done with, by final outcome", ["outcome"])
+IN_FLIGHT = Gauge("broadcast_requests_in_flight", "Bot API requests awaiting a response")
+SEND_LATENCY = Histogram("broadcast_send_latency_seconds", "Bot API request latency", buckets=LATENCY_BUCKETS)
+PACER_WAIT = Histogram("broadcast_pacer_wait_seconds", "Time a send waited for the rate limiter", buckets=LATENCY_BUCKETS)
+FLUSH_LATENCY = Histogram("broadcast_flush_seconds", "Time to record a batch of results", buckets=LATENCY_BUCKETS)
+QUEUE_DEPTH = Gauge("broadcast_queue_depth", "Recipients held by this worker, by queue", ["queue"])
+
+
+def send_result(status_code, outcome):
+    """Name the result of one send for ``SENDS``: ok, or the class of error."""
+    if outcome == SENT:
+        return "ok"
+    if status_code is None:
+        return "network_error"
+    if status_code == 429:
+        return "rate_limited"
+    if status_code >= 500:
+        return "server_error"
+    if outcome == BLOCKED:
+        return "blocked"
+    return "rejected"
+
+
+def delivery_outcome(outcome):
+    # A recipient whose retries ran out keeps the RETRY outcome, but is recorded as failed
+    return outcome if outcome in (SENT, BLOCKED) else FAILED
+
+
+def track_queue(name, depth):
+    """Report ``depth()`` as the depth of ``name`` whenever metrics are scraped."""
+    QUEUE_DEPTH.labels(name).set_function(depth)
+
+
+def serve(stderr=sys.stderr):
+    """Expose this worker's metrics over HTTP. Return the port, or None if none is configured or free.
+
+    Each worker process on a host takes the first free port from ``BROADCAST_METRICS_PORT``
+    on, one per ``BROADCAST_WORKER_PROCESSES``. It listens on ``BROADCAST_METRICS_ADDR``,
+    the loopback interface unless configured otherwise.
+    """
+    if not settings.BROADCAST_METRICS_PORT:
+        return None
+    for port in range(settings.BROADCAST_METRICS_PORT,
+                      settings.BROADCAST_METRICS_PORT + settings.BROADCAST_WORKER_PROCESSES):
+        try:
+            start_http_server(port, addr=settings.BROADCAST_METRICS_ADDR)
+            return port
+        except OSError:
+            continue
+    stderr.write(f"No free metrics port from {settings.BROADCAST_METRICS_PORT}; metrics are not exposed.\n")
+    return None
+
+
+class BacklogCollector:
+    """Broadcasts and shards by status, read from the database at scrape time by the web process."""
+
+    def collect(self):
+        for name, model, documentation in (
+            ("broadcast_broadcasts", Broadcast, "Broadcasts by status"),
+            ("broadcast_shards", BroadcastShard, "Broadcast shards by status"),
+        ):
+            family = GaugeMetricFamily(name, documentation, labels=["status"])
+            for row in model.objects.order_by().values("status").annotate(count=Count("id")):
+                family.add_metric([row["status"]], row["count"])
+            yield family
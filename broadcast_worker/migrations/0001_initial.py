@@ -0,0 +1,32 @@
+# Generated by Django 5.1.4 on 2026-10-18 16:35
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+        ('broadcast', '0006_broadcasttarget_telegram_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BroadcastShard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField()),
+                ('start', models.BigIntegerField()),
+                ('end', models.BigIntegerField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('inprogress', 'In Progress'), ('completed', 'Completed')], default='pending', max_length=10)),
+                ('worker', models.CharField(blank=True, default='', max_length=255)),
+                ('lease_expires_at', models.DateTimeField(blank=True, null=True)),
+                ('broadcast', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shards', to='broadcast.broadcast')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('broadcast', 'index'), name='unique_broadcast_shard')],
+            },
+        ),
+    ]
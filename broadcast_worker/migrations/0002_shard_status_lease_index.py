@@ -0,0 +1,18 @@
+# Generated by Django 5.1.4 on 2026-10-18 17:03
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('broadcast', '0010_hot_query_indexes'),
+        ('broadcast_worker', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='broadcastshard',
+            index=models.Index(fields=['status', 'lease_expires_at'], name='shard_status_lease_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1.4 on 2026-10-18 17:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('broadcast', '0014_broadcast_schedule'),
+        ('broadcast_worker', '0002_shard_status_lease_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='broadcastshard',
+            name='not_before',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='broadcastshard',
+            index=models.Index(fields=['status', 'not_before'], name='shard_status_not_before_idx'),
+        ),
+    ]
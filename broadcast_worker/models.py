@@ -1,3 +1,32 @@
 from django.db import models
 
-# Create your models here.
+from broadcast.models import Broadcast
+
+
+# A slice of a broadcast's recipients that one worker process claims and sends at a time
+class BroadcastShard(models.Model):
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('inprogress', 'In Progress'),
+        ('completed', 'Completed'),
+    ]
+
+    broadcast = models.ForeignKey(Broadcast, on_delete=models.CASCADE, related_name='shards')
+    index = models.PositiveIntegerField()
+    start = models.BigIntegerField()  # First User.id, or list position for an explicit audience
+    end = models.BigIntegerField()  # Exclusive upper bound of the same
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    worker = models.CharField(max_length=255, blank=True, default='')  # Current lease holder
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    not_before = models.DateTimeField(null=True, blank=True)  # Staggers the shards of a delivery window
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['broadcast', 'index'], name='unique_broadcast_shard'),
+        ]
+        indexes = [
+            # Claims look for pending shards and expired leases among mostly completed ones
+            models.Index(fields=['status', 'lease_expires_at'], name='shard_status_lease_idx'),
+            # The next shard held back by a delivery window, to sleep until it is due
+            models.Index(fields=['status', 'not_before'], name='shard_status_not_before_idx'),
+        ]
@@ -0,0 +1,128 @@
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    """Token bucket refilled at ``rate`` tokens per second, holding at most ``capacity`` tokens.
+
+    Tokens are handed out by reservation: ``reserve`` always debits the bucket and
+    returns how long the caller has to wait before its token is actually available.
+    This lets the same bucket pace both threads and coroutines.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_at = None
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        elapsed = now - self.updated_at
+        if elapsed > 0:
+            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
+            self.updated_at = now
+
+    def reserve(self, now=None):
+        """Take one token and return the number of seconds to wait before using it."""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def pause(self, seconds, now=None):
+        """Hand out no tokens for the next ``seconds`` seconds."""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        self.tokens = min(self.tokens, -seconds * self.rate)
+        self.paused_at = now
+        self.paused_until = max(self.paused_until, now + seconds)
+
+    def paused_after(self, reserved_at, now=None):
+        """Return whether a pause that began after ``reserved_at`` still holds tokens back at ``now``.
+
+        A token reserved before the pause does not account for it, so its holder has to reserve again.
+        """
+        now = time.monotonic() if now is None else now
+        return self.paused_at is not None and self.paused_at >= reserved_at and self.paused_until > now
+
+    def is_full(self, now=None):
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class Pacer:
+    """Paces sends against a global rate limit and a per-chat rate limit.
+
+    Safe to share between the threads of a worker pool; the async command awaits
+    ``wait`` instead of calling ``acquire``.
+    """
+
+    MAX_TRACKED_CHATS = 10000  # Per-chat buckets kept before idle ones are pruned
+
+    def __init__(self, rate, per_chat_rate=None):
+        self.bucket = TokenBucket(rate)
+        self.per_chat_rate = per_chat_rate
+        self.chat_buckets = {}
+        self.lock = threading.Lock()
+
+    def reserve(self, chat_id=None):
+        """Reserve a send slot and return the delay in seconds before it may be used."""
+        with self.lock:
+            now = time.monotonic()
+            delay = self.bucket.reserve(now)
+            if chat_id is not None and self.per_chat_rate:
+                chat_bucket = self.chat_buckets.get(chat_id)
+                if chat_bucket is None:
+                    if len(self.chat_buckets) >= self.MAX_TRACKED_CHATS:
+                        self._prune(now)
+                    chat_bucket = self.chat_buckets[chat_id] = TokenBucket(self.per_chat_rate, 1)
+                delay = max(delay, chat_bucket.reserve(now))
+            return delay
+
+    def pause(self, seconds):
+        """Stop all sends for ``seconds`` seconds, e.g. when Telegram answers 429 with ``retry_after``."""
+        with self.lock:
+            self.bucket.pause(seconds)
+
+    def _prune(self, now):
+        """Drop per-chat buckets that have fully refilled; they carry no state."""
+        self.chat_buckets = {
+            chat_id: bucket for chat_id, bucket in self.chat_buckets.items() if not bucket.is_full(now)
+        }
+
+    def acquire(self, chat_id=None):
+        """Block the calling thread until a send slot is available. Return the seconds waited.
+
+        A slot that comes up during a flood wait that started after it was reserved is given
+        up for a new one behind the flood wait.
+        """
+        waited = 0.0
+        while True:
+            reserved_at = time.monotonic()
+            delay = self.reserve(chat_id)
+            if delay > 0:
+                time.sleep(delay)
+                waited += delay
+            if not self.bucket.paused_after(reserved_at):
+                return waited
+
+    async def wait(self, chat_id=None):
+        """Suspend the calling coroutine until a send slot is available. Return the seconds waited.
+
+        Like ``acquire``, a slot overtaken by a flood wait is reserved again.
+        """
+        waited = 0.0
+        while True:
+            reserved_at = time.monotonic()
+            delay = self.reserve(chat_id)
+            if delay > 0:
+                await asyncio.sleep(delay)
+                waited += delay
+            if not self.bucket.paused_after(reserved_at):
+                return waited
@@ -0,0 +1,93 @@
+import json
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+
+class CompiledPayload:
+    """Bot API request for one broadcast, built and serialized once and reused for every recipient.
+
+    The JSON body is kept as two byte strings around the ``chat_id`` value, so rendering
+    the request for a user is a single bytes join. A broadcast whose uploaded media has no
+    file_id yet ``needs_upload``: its send carries the file as a multipart form instead, and
+    the file_id Telegram returns is used from then on.
+    """
+
+    # Broadcast type -> (Bot API method, field holding the message, field holding the file_id)
+    METHODS = {
+        "text": ("sendMessage", "text", None),
+        "image": ("sendPhoto", "caption", "photo"),
+        "video": ("sendVideo", "caption", "video"),
+    }
+
+    def __init__(self, broadcast, api_url=""):
+        self.method, self.params = self.build_params(broadcast)
+        self.file_field = self.METHODS[broadcast.type][2]
+        self.media = broadcast.media if broadcast.media_id and self.file_field else None
+        self.url = f"{api_url}/{self.method}"
+        self.compile()
+
+    def compile(self):
+        body = json.dumps(self.params, ensure_ascii=False, separators=(",", ":")).encode()
+        self.prefix = b'{"chat_id":'
+        self.suffix = b"," + body[1:] if self.params else b"}"
+
+    @classmethod
+    def build_params(cls, broadcast):
+        """Return the Bot API method and its parameters, excluding ``chat_id``."""
+        method, text_field, file_field = cls.METHODS[broadcast.type]
+        params = {}
+        if file_field:
+            params[file_field] = broadcast.media.file_id if broadcast.media_id else broadcast.file_id
+        params[text_field] = broadcast.message
+
+        if broadcast.buttons:
+            inline_keyboard = []
+            for btn in broadcast.buttons:
+                if btn.get("web_app"):
+                    inline_keyboard.append([{"text": btn["text"], "web_app": {"url": btn["url"]}}])
+                else:
+                    inline_keyboard.append([{"text": btn["text"], "url": btn["url"]}])
+
+            params["reply_markup"] = {"inline_keyboard": inline_keyboard}
+        return method, params
+
+    def render(self, chat_id):
+        """Return the serialized JSON body addressed to ``chat_id``."""
+        return b"".join((self.prefix, str(int(chat_id)).encode(), self.suffix))
+
+    @property
+    def file_id(self):
+        return self.params.get(self.file_field) if self.file_field else None
+
+    @property
+    def needs_upload(self):
+        return self.media is not None and not self.file_id
+
+    def use_file_id(self, file_id):
+        """Send the media by ``file_id`` from now on."""
+        self.params[self.file_field] = file_id
+        self.compile()
+
+    def upload_fields(self, chat_id):
+        """Return the form fields of a send to ``chat_id`` that uploads the media, all but the file."""
+        fields = {"chat_id": str(int(chat_id))}
+        for name, value in self.params.items():
+            if name != self.file_field:
+                fields[name] = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+        return fields
+
+    def read_media(self):
+        with self.media.file.storage.open(self.media.file.name, "rb") as file:
+            return file.read()
+
+    def file_id_from(self, body):
+        """Return the file_id Telegram gave the media in the response to a send that uploaded it."""
+        result = body.get("result") if isinstance(body, dict) else None
+        if not isinstance(result, dict):
+            return None
+        if self.file_field == "photo":
+            sizes = result.get("photo") or [{}]
+            return sizes[-1].get("file_id")  # The largest size, as uploaded
+        # Telegram may file a video it cannot play as an animation or a document
+        sent = result.get("video") or result.get("animation") or result.get("document") or {}
+        return sent.get("file_id")
@@ -0,0 +1,75 @@
+import atexit
+import cProfile
+import functools
+import inspect
+import os
+import pstats
+import threading
+from pathlib import Path
+
+from django.conf import settings
+
+PROFILE_DIR = settings.BROADCAST_PROFILE_DIR
+
+local = threading.local()
+profiles = []  # One per thread that ran profiled code
+lock = threading.Lock()
+
+
+def profiled(function):
+    """Profile calls of ``function`` with cProfile when ``BROADCAST_PROFILE_DIR`` is set.
+
+    Otherwise ``function`` is returned unchanged, so the hooks cost nothing in production.
+    Each thread has its own profile, and nested profiled calls extend the outer one; the
+    merged stats are written to ``<pid>.prof`` in the directory when the process exits.
+    """
+    if not PROFILE_DIR:
+        return function
+
+    if inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            enable()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                disable()
+    else:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            enable()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                disable()
+    return wrapper
+
+
+def enable():
+    if not hasattr(local, "profile"):
+        local.profile = cProfile.Profile()
+        local.depth = 0
+        with lock:
+            profiles.append(local.profile)
+    if local.depth == 0:
+        local.profile.enable()
+    local.depth += 1
+
+
+def disable():
+    local.depth -= 1
+    if local.depth == 0:
+        local.profile.disable()
+
+
+def dump():
+    if not profiles:
+        return
+    with lock:
+        stats = pstats.Stats(*profiles)
+    Path(PROFILE_DIR).mkdir(parents=True, exist_ok=True)
+    stats.dump_stats(Path(PROFILE_DIR) / f"{os.getpid()}.prof")
+
+
+if PROFILE_DIR:
+    atexit.register(dump)
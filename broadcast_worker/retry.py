@@ -0,0 +1,81 @@
+import heapq
+import itertools
+import random
+import time
+
+SENT = "sent"
+RETRY = "retry"  # Transient: rate limited, server error or network failure
+FAILED = "failed"  # Permanent: the message will never be accepted for this chat
+BLOCKED = "blocked"  # Permanent, and the user will not receive any broadcast until they restart the bot
+
+# 403 descriptions that mean the user can no longer be reached at all
+UNREACHABLE = ("bot was blocked by the user", "user is deactivated")
+
+
+def classify(status_code, body):
+    """Classify a Bot API response. Return ``(outcome, retry_after, description)``.
+
+    ``retry_after`` is the flood-wait Telegram asks for on a 429, in seconds, or None.
+    """
+    body = body if isinstance(body, dict) else {}
+    description = body.get("description", "")
+    if 200 <= status_code < 300:
+        return SENT, None, description
+    if status_code == 429:
+        return RETRY, body.get("parameters", {}).get("retry_after", 1), description
+    if status_code >= 500:
+        return RETRY, None, description
+    if status_code == 403 and any(reason in description for reason in UNREACHABLE):
+        return BLOCKED, None, description
+    return FAILED, None, description
+
+
+class RetryQueue:
+    """Recipients whose send failed transiently, ordered by when they may be retried.
+
+    Delays follow Telegram's ``retry_after`` when given, else exponential backoff with
+    jitter. A recipient that has used up ``max_attempts`` is not scheduled again.
+    """
+
+    BASE_DELAY = 1  # Seconds before the first retry
+    MAX_DELAY = 60
+
+    def __init__(self, max_attempts):
+        self.max_attempts = max_attempts
+        self.attempts = {}
+        self.heap = []
+        self.counter = itertools.count()  # Keeps heap order stable for equal due times
+
+    def __len__(self):
+        return len(self.heap)
+
+    def schedule(self, chat_id, retry_after=None):
+        """Queue ``chat_id`` for another attempt. Return False if it has no attempts left."""
+        attempt = self.attempts.get(chat_id, 0) + 1
+        if attempt > self.max_attempts:
+            self.attempts.pop(chat_id, None)
+            return False
+        self.attempts[chat_id] = attempt
+        if retry_after:
+            delay = retry_after
+        else:
+            delay = min(self.BASE_DELAY * 2 ** (attempt - 1), self.MAX_DELAY) * random.uniform(0.5, 1.5)
+        heapq.heappush(self.heap, (time.monotonic() + delay, next(self.counter), chat_id))
+        return True
+
+    def forget(self, chat_id):
+        """Drop the attempt count of a recipient whose send succeeded or failed for good."""
+        self.attempts.pop(chat_id, None)
+
+    def next_batch(self, users, batch_size):
+        """Return up to ``batch_size`` recipients: retries that are due first, then new ones from ``users``."""
+        now = time.monotonic()
+        batch = []
+        while self.heap and self.heap[0][0] <= now and len(batch) < batch_size:
+            batch.append(heapq.heappop(self.heap)[2])
+        batch.extend(itertools.islice(users, batch_size - len(batch)))
+        return batch
+
+    def next_due_in(self):
+        """Seconds until the earliest queued retry is due."""
+        return max(self.heap[0][0] - time.monotonic(), 0) if self.heap else 0
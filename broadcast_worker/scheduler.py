@@ -0,0 +1,105 @@
+import math
+import time
+
+from broadcast_worker.retry import RETRY, SENT
+
+
+class ShardRun:
+    """A claimed shard a worker is sending: its recipients, retries, unrecorded results and counts.
+
+    A broadcast with a delivery window is paced to ``total_target_users / window`` messages
+    per second, in batches of about a second's worth. ``uploading`` is set while the worker
+    holds the claim to upload the broadcast's media.
+    """
+
+    def __init__(self, shard, payload, users, retries, recorder, progress):
+        self.shard = shard
+        self.payload = payload
+        self.users = users
+        self.retries = retries
+        self.recorder = recorder
+        self.progress = progress
+        self.weight = 2 ** shard.broadcast.priority
+        self.finish_tag = 0.0
+        self.successful = 0
+        self.failed = 0
+        window = shard.broadcast.delivery_window
+        self.rate = max(shard.broadcast.total_target_users, 1) / window.total_seconds() if window else None
+        self.paced_until = 0.0
+        self.uploading = False
+
+    def batch_size(self, batch_size):
+        if self.rate is None:
+            return batch_size
+        return max(1, min(batch_size, math.ceil(self.rate)))
+
+    def due_in(self):
+        """Seconds until the pace of a delivery window, or a hold, allows the next batch."""
+        return max(self.paced_until - time.monotonic(), 0)
+
+    def hold(self, seconds):
+        """Send nothing for ``seconds``, e.g. while another worker uploads the media."""
+        self.paced_until = max(self.paced_until, time.monotonic() + seconds)
+
+    def sent(self, count):
+        if self.rate is not None:
+            self.paced_until = max(self.paced_until, time.monotonic()) + count / self.rate
+
+    def add_result(self, user_id, outcome, retry_after):
+        """Count the outcome of one send, or queue the recipient for a retry."""
+        if outcome == RETRY and self.retries.schedule(user_id, retry_after):
+            return
+        self.retries.forget(user_id)
+        if outcome == SENT:
+            self.successful += 1
+        else:
+            self.failed += 1
+        self.recorder.add(user_id, outcome)
+        self.progress.add(outcome)
+
+
+class FairScheduler:
+    """Weighted fair queuing of the shards one worker sends side by side.
+
+    Every run has a virtual finish tag that grows by ``messages / weight`` as it sends, and
+    the run with the lowest tag sends the next batch. Under the worker's one rate limit a
+    broadcast of priority ``p`` therefore gets a ``2 ** p`` share of the messages, and a
+    small broadcast is done after its own few batches instead of after every broadcast
+    claimed before it. A run that joins starts at the lowest tag in use, so it neither
+    waits out the others' history nor claims credit for time it was not there.
+    """
+
+    def __init__(self):
+        self.runs = []
+
+    def __len__(self):
+        return len(self.runs)
+
+    def __iter__(self):
+        return iter(list(self.runs))
+
+    def add(self, run):
+        run.finish_tag = min((other.finish_tag for other in self.runs), default=0.0)
+        self.runs.append(run)
+
+    def remove(self, run):
+        self.runs.remove(run)
+
+    def in_order(self):
+        """Return the runs by finish tag, higher priority first on a tie."""
+        return sorted(self.runs, key=lambda run: (run.finish_tag, -run.weight))
+
+    def charge(self, run, sent):
+        run.finish_tag += sent / run.weight
+        run.sent(sent)
+
+    def broadcast_ids(self):
+        return {run.shard.broadcast_id for run in self.runs}
+
+    def next_due_in(self):
+        """Seconds until any run may send again: its earliest retry is due, or its pace or hold allows it."""
+        return min(
+            [run.retries.next_due_in() for run in self.runs if run.retries]
+            + [due_in for due_in in map(ShardRun.due_in, self.runs) if due_in],
+            default=0,
+        )
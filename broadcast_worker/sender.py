@@ -0,0 +1,148 @@
+import os
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import DatabaseError
+
+from broadcast_worker import metrics
+from broadcast_worker.claims import (
+    claim_shard, claim_upload, complete_shard, release_lease, release_upload, renew_lease, renew_upload,
+)
+from broadcast_worker.delivery import ResultRecorder
+from broadcast_worker.events import ProgressPublisher
+from broadcast_worker.pacer import Pacer
+from broadcast_worker.payload import CompiledPayload
+from broadcast_worker.retry import RetryQueue
+from broadcast_worker.scheduler import FairScheduler, ShardRun
+
+
+class SenderCommand(BaseCommand):
+    """What the threaded ``broadcast`` and the async ``send_broadcasts`` commands share.
+
+    Both claim up to ``ACTIVE_SHARDS`` shards, send them side by side in fair-queuing order
+    and record their results in the background; they differ in how messages are sent and
+    how they wait. A subclass sets ``BATCH_SIZE`` and provides ``read_recipients(shard)``,
+    an iterator over the shard's recipients, and ``submit_write(fn, *args)``, which starts
+    a result write and returns a future. The methods here block on the database, so the
+    async command calls them through ``sync_to_async``.
+    """
+
+    BOT_TOKEN = os.environ.get("BOT_TOKEN")
+    if not BOT_TOKEN:
+        exit("BOT_TOKEN environment variable not set")
+    # Telegram allows 30 messages per second, shared by all worker processes
+    RATE_LIMIT = settings.BROADCAST_RATE_LIMIT / settings.BROADCAST_WORKER_PROCESSES
+    PER_CHAT_RATE_LIMIT = settings.BROADCAST_PER_CHAT_RATE_LIMIT
+    PAGE_SIZE = settings.BROADCAST_PAGE_SIZE  # Recipients read per query
+    TELEGRAM_BOT_API_URL = "{}/bot{}".format(settings.TELEGRAM_BOT_API_URL, BOT_TOKEN)
+    REQUEST_TIMEOUT = 30  # Seconds to wait for a response from the Bot API
+    UPLOAD_TIMEOUT = 300  # Seconds to wait for a send that uploads a video or image
+    UPLOAD_POLL_INTERVAL = 1  # Seconds between checks for the file_id of media another worker uploads
+    POLL_INTERVAL = settings.BROADCAST_POLL_INTERVAL  # Seconds between checks when no wakeup arrives
+    MAX_RETRIES = settings.BROADCAST_MAX_RETRIES
+    ACTIVE_SHARDS = settings.BROADCAST_ACTIVE_SHARDS  # Broadcasts sent side by side
+    # Leases are also renewed this often from a thread or task of their own, as a batch can outlast a lease
+    # in a long flood wait
+    HEARTBEAT_INTERVAL = settings.BROADCAST_LEASE_SECONDS / 6
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pacer = Pacer(self.RATE_LIMIT, self.PER_CHAT_RATE_LIMIT)
+        self.wakeup = None
+        self.scheduler = FairScheduler()
+        self.next_claim = 0  # When to look for new broadcasts again if no wakeup arrives first
+        self.stopping = False
+        metrics.track_queue("retry", lambda: sum(len(run.retries) for run in self.scheduler))
+        metrics.track_queue("unrecorded", lambda: sum(len(run.recorder) for run in self.scheduler))
+
+    def serve_metrics(self):
+        port = metrics.serve(self.stderr)
+        if port:
+            self.stdout.write(f"Serving metrics on {settings.BROADCAST_METRICS_ADDR}:{port}")
+
+    def stop(self, *args):
+        """Exit once the batch being sent is done; the SIGTERM handler, as process managers stop workers with it."""
+        self.stopping = True
+
+    def claim_runs(self):
+        """Claim shards until ``ACTIVE_SHARDS`` are held. Return False if no broadcast had a free one."""
+        while len(self.scheduler) < self.ACTIVE_SHARDS:
+            # One shard per broadcast; more would not send it any faster under the one rate limit
+            shard = claim_shard(exclude=self.scheduler.broadcast_ids())
+            if not shard:
+                return False
+            self.stdout.write(f"Processing broadcast ID: {shard.broadcast_id} (shard {shard.index})")
+            self.scheduler.add(ShardRun(
+                shard,
+                CompiledPayload(shard.broadcast, self.TELEGRAM_BOT_API_URL),
+                self.read_recipients(shard),
+                RetryQueue(self.MAX_RETRIES),
+                ResultRecorder(shard, self.submit_write),
+                ProgressPublisher(shard.broadcast_id),
+            ))
+        return True
+
+    def batch_size(self, run):
+        # A single message uploads the media; the rest wait to send its file_id
+        return 1 if run.payload.needs_upload else run.batch_size(self.BATCH_SIZE)
+
+    def start_upload(self, run):
+        """Return True if ``run`` may send: this worker is to upload its media, or the file_id is now known.
+
+        Otherwise another worker is uploading the media and ``run`` is held until it is done.
+        """
+        media = run.payload.media
+        if run.uploading or claim_upload(media):
+            run.uploading = True
+            return True
+        if media.file_id:
+            run.payload.use_file_id(media.file_id)
+            return True
+        run.hold(self.UPLOAD_POLL_INTERVAL)
+        return False
+
+    def renew_claims(self):
+        """Renew the lease of every claimed shard and upload, however long the main loop waits on a batch.
+
+        Runs every ``HEARTBEAT_INTERVAL``; a lost lease is left for the main loop to find.
+        """
+        for run in self.scheduler:
+            try:
+                renew_lease(run.shard)
+                if run.uploading and not renew_upload(run.payload.media):
+                    # Taken over after this worker stalled; the run waits for the new holder's file_id
+                    self.stderr.write(f"Lost the upload claim on media {run.payload.media.id}.")
+                    run.uploading = False
+            except DatabaseError as e:
+                self.stderr.write(f"Failed to renew the lease on shard {run.shard.index}: {e}")
+
+    def drop_run(self, run, lost=False):
+        """Stop sending ``run`` and give up its upload claim; ``lost`` if another worker took the shard over."""
+        if lost:
+            self.stderr.write(f"Lost the claim on shard {run.shard.index} of broadcast {run.shard.broadcast_id}.")
+        self.scheduler.remove(run)
+        self.next_claim = 0  # The broadcast's next shard, or another broadcast, can take its place
+        if run.uploading:
+            release_upload(run.payload.media)
+
+    def complete_run(self, run):
+        """Report a run whose results are all recorded, and complete its broadcast if it was the last shard."""
+        shard, broadcast = run.shard, run.shard.broadcast
+        run.progress.flush()
+        self.stdout.write(f"Shard {shard.index} of broadcast {broadcast.id} done: "
+                          f"{run.successful} successful, {run.failed} failed.")
+
+        # Mark broadcast as completed once its last shard is done
+        if complete_shard(shard):
+            broadcast.refresh_from_db()
+            self.stdout.write(f"Broadcast {broadcast.id} completed: {broadcast.total_successful} successful, "
+                              f"{broadcast.total_failed} failed.")
+
+    def release_run(self, run, owned):
+        """Give up ``run`` as the worker exits, its results recorded unless the lease was lost (``owned`` False).
+
+        Its shard is released too, so any worker resumes it straight away from the first recipient not recorded.
+        """
+        if owned:
+            release_lease(run.shard)
+        self.drop_run(run, lost=not owned)
@@ -0,0 +1,13 @@
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+
+from broadcast.models import Broadcast
+from broadcast_worker.wakeup import notify_workers
+
+
+@receiver(post_save, sender=Broadcast)
+def wake_workers(sender, instance, created, **kwargs):
+    """Start idle workers on a new or newly started broadcast once it is visible to them."""
+    if instance.status == "pending":
+        transaction.on_commit(notify_workers)
@@ -1,3 +1,452 @@
-from django.test import TestCase
+import asyncio
+import io
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from datetime import timedelta
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.core.files.base import ContentFile
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from broadcast.models import Broadcast, BroadcastTarget, Media, User
+from broadcast_worker.benchmark import FakeBotAPI
+from broadcast_worker.claims import (
+    claim_shard, claim_upload, complete_shard, next_due_in, release_upload, renew_lease, renew_upload, store_file_id,
+)
+from broadcast_worker import claims, metrics
+from broadcast_worker.delivery import record_results, recipients
+from broadcast_worker.management.commands import broadcast
+from broadcast_worker.models import BroadcastShard
+from broadcast_worker.pacer import Pacer, TokenBucket
+from broadcast_worker.retry import BLOCKED, FAILED, RETRY, SENT, RetryQueue, classify
+from broadcast_worker.scheduler import FairScheduler, ShardRun
+from broadcast_worker.wakeup import Wakeup
+
+
+class TokenBucketTests(SimpleTestCase):
+    def test_reserve_spends_the_burst_then_waits(self):
+        bucket = TokenBucket(10)
+        now = bucket.updated_at
+        for _ in range(10):
+            self.assertEqual(bucket.reserve(now), 0)
+        self.assertAlmostEqual(bucket.reserve(now), 0.1)
+        self.assertAlmostEqual(bucket.reserve(now), 0.2)
+        # Refilled at the rate, up to the capacity
+        self.assertEqual(bucket.reserve(now + 10), 0)
+
+    def test_pause_holds_back_every_token(self):
+        bucket = TokenBucket(10)
+        now = bucket.updated_at
+        bucket.pause(2, now)
+        self.assertAlmostEqual(bucket.reserve(now), 2.1)
+        self.assertFalse(bucket.is_full(now + 2))
+        self.assertTrue(bucket.is_full(now + 4))
+
+
+class PacerTests(SimpleTestCase):
+    def test_a_waiting_send_sits_out_a_later_pause(self):
+        pacer = Pacer(10)
+        for _ in range(10):
+            pacer.reserve()
+        # The next slot is 0.1 s away; a flood wait of 0.3 s starts before it comes up
+        threading.Timer(0.05, pacer.pause, [0.3]).start()
+        started = time.monotonic()
+        pacer.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.35)
+
+    def test_a_waiting_coroutine_sits_out_a_later_pause(self):
+        pacer = Pacer(10)
+        for _ in range(10):
+            pacer.reserve()
+
+        async def send():
+            asyncio.get_running_loop().call_later(0.05, pacer.pause, 0.3)
+            started = time.monotonic()
+            await pacer.wait()
+            return time.monotonic() - started
+
+        self.assertGreaterEqual(asyncio.run(send()), 0.35)
+
+    def test_a_pause_already_waited_for_is_not_waited_again(self):
+        pacer = Pacer(10)
+        pacer.pause(0.2)
+        started = time.monotonic()
+        pacer.acquire()
+        # The pause and the one slot after it, not a second round of either
+        self.assertLess(time.monotonic() - started, 0.45)
+
+
+class ClassifyTests(SimpleTestCase):
+    def test_outcomes(self):
+        self.assertEqual(classify(200, {"ok": True}), (SENT, None, ""))
+        self.assertEqual(classify(429, {"parameters": {"retry_after": 7}, "description": "Too Many Requests"}),
+                         (RETRY, 7, "Too Many Requests"))
+        self.assertEqual(classify(429, None)[:2], (RETRY, 1))
+        self.assertEqual(classify(502, None)[:2], (RETRY, None))
+        self.assertEqual(classify(403, {"description": "Forbidden: bot was blocked by the user"})[0], BLOCKED)
+        self.assertEqual(classify(403, {"description": "Forbidden: user is deactivated"})[0], BLOCKED)
+        self.assertEqual(classify(403, {"description": "Forbidden: bot can't initiate conversation"})[0], FAILED)
+        self.assertEqual(classify(400, {"description": "Bad Request: chat not found"})[0], FAILED)
+
+
+class RetryQueueTests(SimpleTestCase):
+    def test_no_retries(self):
+        retries = RetryQueue(0)
+        self.assertFalse(retries.schedule(1))
+        self.assertEqual(len(retries), 0)
+
+    def test_attempts_are_counted_until_forgotten(self):
+        retries = RetryQueue(2)
+        self.assertTrue(retries.schedule(1, retry_after=0.01))
+        self.assertTrue(retries.schedule(1, retry_after=0.01))
+        self.assertFalse(retries.schedule(1))
+        self.assertNotIn(1, retries.attempts)
+        self.assertTrue(retries.schedule(2, retry_after=0.01))
+        retries.forget(2)
+        self.assertEqual(retries.attempts, {})
+
+    def test_due_retries_come_first(self):
+        retries = RetryQueue(3)
+        retries.schedule(1, retry_after=0.01)
+        retries.schedule(2, retry_after=60)
+        time.sleep(0.02)
+        self.assertEqual(retries.next_batch(iter([3, 4, 5]), 3), [1, 3, 4])
+        self.assertEqual(len(retries), 1)
+
+
+def shard_run(broadcast_id, priority=1, total_target_users=0, delivery_window=None):
+    broadcast = SimpleNamespace(id=broadcast_id, priority=priority, total_target_users=total_target_users,
+                                delivery_window=delivery_window)
+    shard = SimpleNamespace(broadcast=broadcast, broadcast_id=broadcast_id)
+    return ShardRun(shard, None, iter(()), RetryQueue(0), None, None)
+
+
+class FairSchedulerTests(SimpleTestCase):
+    def send(self, scheduler, batches):
+        sent = {}
+        for _ in range(batches):
+            run = scheduler.in_order()[0]
+            scheduler.charge(run, 10)
+            sent[run.shard.broadcast_id] = sent.get(run.shard.broadcast_id, 0) + 10
+        return sent
+
+    def test_shares_follow_priority(self):
+        scheduler = FairScheduler()
+        scheduler.add(shard_run(1, priority=0))
+        scheduler.add(shard_run(2, priority=2))
+        self.assertEqual(self.send(scheduler, 50), {1: 100, 2: 400})
+
+    def test_a_run_that_joins_late_starts_level(self):
+        scheduler = FairScheduler()
+        scheduler.add(shard_run(1))
+        self.send(scheduler, 20)
+        scheduler.add(shard_run(2))
+        # It takes turns with the first run rather than sending until it has caught up
+        self.assertEqual(self.send(scheduler, 10), {1: 50, 2: 50})
+        self.assertEqual(scheduler.broadcast_ids(), {1, 2})
+
+    def test_a_delivery_window_paces_its_run(self):
+        scheduler = FairScheduler()
+        run = shard_run(1, total_target_users=3600, delivery_window=timedelta(hours=1))
+        scheduler.add(run)
+        self.assertEqual(run.batch_size(500), 1)
+        self.assertEqual(scheduler.next_due_in(), 0)
+        scheduler.charge(run, 2)
+        self.assertAlmostEqual(scheduler.next_due_in(), 2, delta=0.1)
+
+
+class MetricsTests(SimpleTestCase):
+    @override_settings(BROADCAST_METRICS_PORT=9310, BROADCAST_WORKER_PROCESSES=2)
+    def test_serves_on_loopback_by_default(self):
+        with mock.patch.object(metrics, "start_http_server", side_effect=[OSError, None]) as start:
+            self.assertEqual(metrics.serve(io.StringIO()), 9311)
+        start.assert_called_with(9311, addr="127.0.0.1")
+
+    @override_settings(BROADCAST_METRICS_PORT=0)
+    def test_port_zero_turns_it_off(self):
+        with mock.patch.object(metrics, "start_http_server") as start:
+            self.assertIsNone(metrics.serve(io.StringIO()))
+        start.assert_not_called()
+
+
+class RecordResultsTests(TestCase):
+    def setUp(self):
+        User.objects.bulk_create([User(telegram_id=telegram_id) for telegram_id in range(1, 11)])
+        self.broadcast = Broadcast.objects.create(message="Hi")
+        self.shard = claim_shard()
+
+    def totals(self):
+        self.broadcast.refresh_from_db()
+        return self.broadcast.total_successful, self.broadcast.total_failed
+
+    def test_outcomes_are_counted_once(self):
+        self.assertTrue(record_results(self.shard, [(1, SENT), (2, FAILED), (3, BLOCKED)]))
+        # A write repeated after a retry, or overlapping with another worker's
+        self.assertTrue(record_results(self.shard, [(1, SENT), (2, SENT), (4, SENT)]))
+        self.assertEqual(self.totals(), (2, 2))
+        self.assertEqual(dict(BroadcastTarget.objects.values_list("telegram_id", "status")),
+                         {1: "sent", 2: "failed", 3: "failed", 4: "sent"})
+        self.assertTrue(User.objects.get(telegram_id=3).blocked)
+
+    def test_pending_targets_are_counted(self):
+        BroadcastTarget.objects.create(broadcast=self.broadcast, telegram_id=5)
+        self.assertTrue(record_results(self.shard, [(5, SENT)]))
+        self.assertEqual(self.totals(), (1, 0))
+
+    def test_a_lost_shard_records_nothing(self):
+        BroadcastShard.objects.filter(id=self.shard.id).update(worker="other:1")
+        self.assertFalse(record_results(self.shard, [(1, SENT), (2, BLOCKED)]))
+        self.assertEqual(self.totals(), (0, 0))
+        self.assertFalse(BroadcastTarget.objects.exists())
+        self.assertFalse(User.objects.filter(blocked=True).exists())
+
+
+@override_settings(BROADCAST_SHARD_SIZE=5)
+class ClaimTests(TestCase):
+    def setUp(self):
+        User.objects.bulk_create([User(telegram_id=telegram_id) for telegram_id in range(1, 11)])
+        self.broadcast = Broadcast.objects.create(message="Hi")
+
+    def test_each_shard_is_claimed_once(self):
+        first, second = claim_shard(), claim_shard()
+        self.assertEqual((first.index, second.index), (0, 1))
+        self.assertIsNone(claim_shard())
+        self.broadcast.refresh_from_db()
+        self.assertEqual((self.broadcast.status, self.broadcast.total_target_users), ("inprogress", 10))
+
+    def test_broadcasts_already_sent_are_skipped(self):
+        other = Broadcast.objects.create(message="Other", priority=0)
+        self.assertEqual(claim_shard().broadcast_id, self.broadcast.id)
+        self.assertEqual(claim_shard(exclude={self.broadcast.id}).broadcast_id, other.id)
+
+    def test_an_expired_lease_is_taken_over(self):
+        shard = claim_shard()
+        self.assertTrue(renew_lease(shard, force=True))
+        BroadcastShard.objects.filter(id=shard.id).update(lease_expires_at=timezone.now())
+        with mock.patch.object(claims, "WORKER_ID", "b:1"):
+            self.assertEqual(claim_shard().id, shard.id)
+        # The first worker finds out, and can no longer complete it
+        self.assertFalse(renew_lease(shard, force=True))
+        complete_shard(shard)
+        self.assertEqual(BroadcastShard.objects.get(id=shard.id).status, "inprogress")
+
+    def test_the_last_shard_completes_the_broadcast(self):
+        first, second = claim_shard(), claim_shard()
+        self.assertFalse(complete_shard(first))
+        self.assertTrue(complete_shard(second))
+        self.broadcast.refresh_from_db()
+        self.assertEqual(self.broadcast.status, "completed")
+
+
+@override_settings(BROADCAST_SHARD_SIZE=5)
+class ScheduleTests(TestCase):
+    def setUp(self):
+        User.objects.bulk_create([User(telegram_id=telegram_id) for telegram_id in range(1, 11)])
+        self.now = timezone.now()
+
+    def test_a_scheduled_broadcast_waits_until_due(self):
+        Broadcast.objects.create(message="Later", scheduled_at=self.now + timedelta(seconds=30))
+        self.assertIsNone(claim_shard())
+        self.assertAlmostEqual(next_due_in(60), 30, delta=1)
+        self.assertEqual(next_due_in(10), 10)
+
+    def test_a_recurring_broadcast_queues_its_next_occurrence(self):
+        scheduled_at = self.now - timedelta(minutes=1)
+        broadcast = Broadcast.objects.create(message="Daily", scheduled_at=scheduled_at, recurrence="daily")
+        self.assertEqual(claim_shard().broadcast_id, broadcast.id)
+        occurrence = Broadcast.objects.exclude(id=broadcast.id).get()
+        self.assertEqual((occurrence.status, occurrence.recurrence, occurrence.message), ("pending", "daily", "Daily"))
+        self.assertEqual(occurrence.scheduled_at, scheduled_at + timedelta(days=1))
+
+    def test_missed_occurrences_are_skipped(self):
+        scheduled_at = self.now - timedelta(days=3, hours=12)
+        broadcast = Broadcast.objects.create(message="Daily", scheduled_at=scheduled_at, recurrence="daily")
+        self.assertEqual(broadcast.schedule_next(self.now).scheduled_at, scheduled_at + timedelta(days=4))
+
+    def test_a_delivery_window_staggers_the_shards(self):
+        Broadcast.objects.create(message="Slowly", delivery_window=timedelta(hours=1))
+        self.assertEqual(claim_shard().index, 0)
+        self.assertIsNone(claim_shard())
+        self.assertAlmostEqual(next_due_in(3600), 1800, delta=5)
+
+
+class ResumeTests(TestCase):
+    def setUp(self):
+        User.objects.bulk_create([User(telegram_id=telegram_id, blocked=telegram_id == 3)
+                                  for telegram_id in range(1, 11)])
+
+    def test_recorded_recipients_are_skipped(self):
+        Broadcast.objects.create(message="Hi")
+        shard = claim_shard()
+        record_results(shard, [(1, SENT), (2, FAILED), (5, SENT)])
+        # Read a page at a time, past the recorded and blocked users
+        self.assertEqual(list(recipients(shard, 3)), [4, 6, 7, 8, 9, 10])
+
+    def test_explicit_audience(self):
+        broadcast = Broadcast.objects.create(message="Hi")
+        broadcast.add_recipients([10, 1, 2, 3, 99])
+        shard = claim_shard()
+        record_results(shard, [(2, SENT)])
+        self.assertEqual(list(recipients(shard, 2)), [1, 10, 99])
+
+
+class InlineExecutor:
+    """Runs result writes on the test's own thread and database connection."""
+
+    def submit(self, fn, *args):
+        future = Future()
+        future.set_result(fn(*args))
+        return future
+
+
+class SentAll(Exception):
+    pass
+
+
+class Worker(broadcast.Command):
+    RATE_LIMIT = 1000
+    PER_CHAT_RATE_LIMIT = None
+    POLL_INTERVAL = 0.1
+    UPLOAD_POLL_INTERVAL = 0.05
+
+    def finish_run(self, run):
+        super().finish_run(run)
+        if not Broadcast.objects.exclude(status="completed").exists():
+            raise SentAll
+
+
+class StoppingWorker(Worker):
+    """Stops after its first batch, as on SIGTERM."""
+
+    def renew_leases(self):
+        super().renew_leases()
+        self.stop()
+
+
+def start_worker(api, worker_class=Worker):
+    """Build a threaded worker against ``api`` that records results on the test's own thread."""
+    worker = worker_class(stdout=io.StringIO(), stderr=io.StringIO())
+    worker.TELEGRAM_BOT_API_URL = f"{api.url}/botx"
+    worker.executor = broadcast.ThreadPoolExecutor(max_workers=8, initializer=worker.init_worker)
+    worker.writer = InlineExecutor()
+    wakeup_dir = tempfile.TemporaryDirectory()
+    worker.wakeup = Wakeup(Path(wakeup_dir.name))
+    return worker, wakeup_dir
+
+
+def stop_worker(worker, wakeup_dir):
+    worker.executor.shutdown()
+    worker.wakeup.close()
+    wakeup_dir.cleanup()
+
+
+class StopTests(TestCase):
+    def setUp(self):
+        self.api = FakeBotAPI(latency=0)
+        self.api.start()
+        self.addCleanup(self.api.server_close)
+        self.addCleanup(self.api.shutdown)
+        User.objects.bulk_create([User(telegram_id=telegram_id) for telegram_id in range(1, 101)])
+
+    def test_buffered_results_are_recorded_and_the_shard_resumed(self):
+        sent = Broadcast.objects.create(message="Hi")
+        worker, wakeup_dir = start_worker(self.api, StoppingWorker)
+        try:
+            worker.process_broadcast()
+            self.assertEqual(len(worker.scheduler.runs[0].recorder), Worker.BATCH_SIZE)
+            worker.release_runs()
+        finally:
+            stop_worker(worker, wakeup_dir)
+        self.assertFalse(worker.scheduler)
+        self.assertEqual(BroadcastTarget.objects.filter(status="sent").count(), Worker.BATCH_SIZE)
+        self.assertLessEqual(BroadcastShard.objects.get().lease_expires_at, timezone.now())
+
+        # Another worker takes the shard over at once and sends only to the rest
+        worker, wakeup_dir = start_worker(self.api)
+        try:
+            with self.assertRaises(SentAll):
+                worker.process_broadcast()
+        finally:
+            stop_worker(worker, wakeup_dir)
+        self.assertEqual(self.api.responses, {200: 100})
+        sent.refresh_from_db()
+        self.assertEqual((sent.status, sent.total_successful), ("completed", 100))
+
+
+class MediaBroadcastTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        media_settings = override_settings(MEDIA_ROOT=media_root.name)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        self.api = FakeBotAPI(latency=0)
+        self.api.start()
+        self.addCleanup(self.api.server_close)
+        self.addCleanup(self.api.shutdown)
+        User.objects.bulk_create([User(telegram_id=telegram_id) for telegram_id in range(1, 51)])
+        self.media = Media(sha256="0" * 64, type="image", filename="photo.jpg", content_type="image/jpeg", size=11)
+        self.media.file.save("photo.jpg", ContentFile(b"image bytes"))
+
+    def send_all(self):
+        worker, wakeup_dir = start_worker(self.api)
+        try:
+            with self.assertRaises(SentAll):
+                worker.process_broadcast()
+        finally:
+            stop_worker(worker, wakeup_dir)
+
+    def test_media_is_uploaded_once(self):
+        first = Broadcast.objects.create(message="Sale", type="image", media=self.media)
+        second = Broadcast.objects.create(message="Last day", type="image", media=self.media)
+        self.send_all()
+
+        self.assertEqual(self.api.uploads, 1)
+        self.media.refresh_from_db()
+        self.assertTrue(self.media.file_id.startswith("fake-"))
+        self.assertIsNone(self.media.upload_expires_at)
+        for sent in (first, second):
+            sent.refresh_from_db()
+            self.assertEqual((sent.status, sent.total_successful, sent.total_failed), ("completed", 50, 0))
+
+        # A later broadcast goes by the stored file_id straight away
+        Broadcast.objects.create(message="Again", type="image", media=self.media)
+        self.send_all()
+        self.assertEqual(self.api.uploads, 1)
+
+    def test_one_worker_at_a_time_uploads(self):
+        self.assertTrue(claim_upload(self.media))
+        self.assertFalse(claim_upload(self.media))
+        self.assertIsNone(self.media.file_id)
+        release_upload(self.media)
+        self.assertTrue(claim_upload(self.media))
+        # A stale claim is renewed while its upload lasts
+        Media.objects.filter(id=self.media.id).update(upload_expires_at=timezone.now())
+        renew_upload(self.media)
+        self.assertFalse(claim_upload(Media.objects.get(id=self.media.id)))
+        store_file_id(self.media, "file-1")
+        other = Media.objects.get(id=self.media.id)
+        self.assertFalse(claim_upload(other))
+        self.assertEqual(other.file_id, "file-1")
+
+    def test_a_stalled_worker_cannot_end_the_claim_that_replaced_its_own(self):
+        self.assertTrue(claim_upload(self.media))
+        Media.objects.filter(id=self.media.id).update(upload_expires_at=timezone.now())
+        with mock.patch.object(claims, "WORKER_ID", "b:1"):
+            self.assertTrue(claim_upload(self.media))
+        # The first worker wakes up to find its claim gone, and leaves the new one be
+        self.assertFalse(renew_upload(self.media))
+        release_upload(self.media)
+        store_file_id(self.media, "stale")
+        with mock.patch.object(claims, "WORKER_ID", "c:1"):
+            self.assertFalse(claim_upload(self.media))
+        self.assertIsNone(self.media.file_id)
+        with mock.patch.object(claims, "WORKER_ID", "b:1"):
+            self.assertTrue(renew_upload(self.media))
+            store_file_id(self.media, "file-1")
+        self.assertEqual(Media.objects.get(id=self.media.id).file_id, "file-1")
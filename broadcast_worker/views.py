@@ -1,3 +1,72 @@
-from django.shortcuts import render
+import asyncio
+import json
 
-# Create your views here.
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, HttpResponseBadRequest, StreamingHttpResponse
+from prometheus_client import CONTENT_TYPE_LATEST, CollectorRegistry, generate_latest
+
+from broadcast.models import Broadcast
+from broadcast.serialisers import BroadcastProgressSerializer
+from broadcast_worker.events import hub
+from broadcast_worker.metrics import BacklogCollector
+
+KEEPALIVE = 15  # Seconds between comments that keep idle connections and proxies open
+
+backlog = CollectorRegistry()
+backlog.register(BacklogCollector())
+
+
+def metrics(request):
+    """Prometheus metrics of the broadcast backlog. Each worker process serves its own on BROADCAST_METRICS_PORT."""
+    return HttpResponse(generate_latest(backlog), content_type=CONTENT_TYPE_LATEST)
+
+
+async def progress_stream(request):
+    """Stream live broadcast progress as server-sent events.
+
+    The stream opens with a ``snapshot`` event holding the unfinished broadcasts, then
+    sends a ``progress`` event for each update from the workers: the status and target
+    count when a broadcast is planned, ``successful``/``failed`` deltas a few times a
+    second while it is sent, and the final totals once it completes. ``?id=`` limits
+    the stream to one broadcast. Served by the ASGI application only.
+    """
+    broadcast_id = request.GET.get("id")
+    if broadcast_id is not None:
+        try:
+            broadcast_id = int(broadcast_id)
+        except ValueError:
+            return HttpResponseBadRequest("id must be an integer")
+    response = StreamingHttpResponse(event_stream(broadcast_id), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"  # Let nginx pass events through as they are written
+    return response
+
+
+async def event_stream(broadcast_id):
+    # Subscribe before reading the snapshot so no update falls between the two
+    queue = hub.subscribe()
+    try:
+        yield server_sent_event("snapshot", await sync_to_async(snapshot)(broadcast_id))
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ": keepalive\n\n"
+                continue
+            if broadcast_id is None or event["id"] == broadcast_id:
+                yield server_sent_event("progress", event)
+    finally:
+        hub.unsubscribe(queue)
+
+
+def snapshot(broadcast_id):
+    broadcasts = Broadcast.objects.order_by("id")
+    if broadcast_id is None:
+        broadcasts = broadcasts.filter(status__in=["pending", "inprogress"])
+    else:
+        broadcasts = broadcasts.filter(id=broadcast_id)
+    return BroadcastProgressSerializer(broadcasts, many=True).data
+
+
+def server_sent_event(name, data):
+    return f"event: {name}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
@@ -0,0 +1,96 @@
+import asyncio
+import os
+import select
+import socket
+import time
+
+from django.conf import settings
+
+WAKEUP_DIR = settings.BROADCAST_WAKEUP_DIR
+
+
+class Wakeup:
+    """Datagram socket an idle worker blocks on until ``notify_workers`` says there is new work.
+
+    Every worker process binds its own socket in ``BROADCAST_WAKEUP_DIR``; waits still time
+    out after the poll interval, so workers on other hosts or platforms without Unix
+    sockets fall back to polling.
+    """
+
+    def __init__(self, directory=WAKEUP_DIR):
+        self.path = directory / f"{os.getpid()}.sock"
+        self.sock = None
+        if hasattr(socket, "AF_UNIX"):
+            directory.mkdir(parents=True, exist_ok=True)
+            if self.path.exists():
+                self.path.unlink()
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.sock.bind(str(self.path))
+            self.sock.setblocking(False)
+
+    def receive(self):
+        """Return the datagrams queued on the socket without blocking."""
+        messages = []
+        try:
+            while True:
+                messages.append(self.sock.recv(65536))
+        except BlockingIOError:
+            pass
+        return messages
+
+    def drain(self):
+        """Discard queued notifications; one check of the database answers all of them. Return True if there were any."""
+        return bool(self.receive())
+
+    def notified(self):
+        """Return True, without blocking, if a notification arrived since the last check."""
+        return self.sock is not None and self.drain()
+
+    def wait(self, timeout):
+        """Block until notified or until ``timeout`` seconds have passed. Return True if notified."""
+        if self.sock is None:
+            time.sleep(timeout)
+            return False
+        select.select([self.sock], [], [], timeout)
+        return self.drain()
+
+    async def wait_async(self, timeout):
+        """Suspend until notified or until ``timeout`` seconds have passed. Return True if notified."""
+        if self.sock is None:
+            await asyncio.sleep(timeout)
+            return False
+        loop = asyncio.get_running_loop()
+        readable = loop.create_future()
+        loop.add_reader(self.sock.fileno(), lambda: readable.done() or readable.set_result(None))
+        try:
+            await asyncio.wait_for(readable, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            loop.remove_reader(self.sock.fileno())
+        return self.drain()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.path.unlink(missing_ok=True)
+
+
+def notify_workers():
+    """Wake every idle worker process on this host."""
+    send_all(WAKEUP_DIR, b"1")
+
+
+def send_all(directory, data):
+    """Send ``data`` to every socket bound in ``directory``, skipping any whose queue is full."""
+    if not hasattr(socket, "AF_UNIX") or not directory.is_dir():
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.setblocking(False)
+        for path in directory.glob("*.sock"):
+            try:
+                sock.sendto(data, str(path))
+            except BlockingIOError:
+                pass  # The receiver is behind; a wakeup is already queued, a progress update is dropped
+            except (ConnectionRefusedError, FileNotFoundError):
+                path.unlink(missing_ok=True)  # Left behind by a process that has exited
@@ -9,6 +9,7 @@ VENV_DIR=".venv"
 MANAGE_PY="manage.py"
 PORT=8000
 COMMAND_NAME="broadcast"
+WORKER_PROCESSES=${BROADCAST_WORKER_PROCESSES:-1}
 
 # Prompt the user for the bot token and set it as an environment variable
 if [ -z "$BOT_TOKEN" ]; then
@@ -29,10 +30,9 @@ is_server_running() {
     return $?
 }
 
-# Function to check if the command is already running
-is_command_running() {
-    pgrep -f "$MANAGE_PY $COMMAND_NAME" > /dev/null
-    return $?
+# Function to count the running instances of the command
+count_command_running() {
+    pgrep -fc "$MANAGE_PY $COMMAND_NAME" || true
 }
 
 # Navigate to the Django project directory
@@ -69,18 +69,24 @@ if [ ! -f "$MANAGE_PY" ]; then
     echo "Error: $MANAGE_PY not found in $PROJECT_DIR. Exiting."
     exit 1
 fi
-nohup python "$MANAGE_PY" runserver &
+# Served over ASGI so the live progress stream (/api/broadcasts/stream/) can push events
+nohup uvicorn BroadcastBot.asgi:application --port $PORT &
 
 # Wait a moment for the server to start
 sleep 5
 
-# Check if the 'send_broadcasts' command is already running
-if is_command_running; then
-    echo "An instance of '$COMMAND_NAME' is already running. Exiting."
+# Start worker processes until BROADCAST_WORKER_PROCESSES instances of the command are running;
+# they claim broadcast shards from the database, so they can safely share the work
+export BROADCAST_WORKER_PROCESSES=$WORKER_PROCESSES
+RUNNING=$(count_command_running)
+if [ "$RUNNING" -ge "$WORKER_PROCESSES" ]; then
+    echo "$RUNNING instance(s) of '$COMMAND_NAME' already running. Exiting."
 else
   # Run the custom Django management command
-  echo "Running the '$COMMAND_NAME' Django command..."
-  nohup python "$MANAGE_PY" $COMMAND_NAME &
+  for ((i = RUNNING; i < WORKER_PROCESSES; i++)); do
+    echo "Running the '$COMMAND_NAME' Django command..."
+    nohup python "$MANAGE_PY" $COMMAND_NAME &
+  done
 fi
 
 # Deactivate the virtual environment
@@ -9,7 +9,7 @@ echo "Stopping Django server and management commands..."
 kill_processes() {
     local SEARCH_TERM=$1
     echo "Searching for processes containing '$SEARCH_TERM'..."
-    PIDS=$(pgrep -f "$SEARCH_TERM")
+    PIDS=$(pgrep -f "$SEARCH_TERM" || true)  # pgrep fails when nothing matches, which would end the script
     if [[ -n "$PIDS" ]]; then
         echo "Found processes with PIDs: $PIDS"
         echo "Stopping processes..."
@@ -20,6 +20,9 @@ kill_processes() {
     fi
 }
 
+# Kill the ASGI server started by run.sh
+kill_processes "uvicorn BroadcastBot.asgi:application"
+
 # Kill Django development server processes
 kill_processes "manage.py runserver"
 